@@ -0,0 +1,239 @@
+import asyncio,threading
+from collections import deque
+from queue import Empty, Full
+from scope import Scope, ScopeError
+
+# asyncio front end for the Scope worker thread.
+#
+# The worker is the same as for Scope, only its output queue is replaced by a
+# LoopQueue: the worker still puts into it from its thread, but the event loop
+# side awaits futures instead of blocking on a get. One event loop can drive
+# any number of scopes next to other instruments:
+#
+#   scope = AsyncScope(...)
+#   await scope.configure(timebase=0x30, voltage={0: 6})
+#   data = await scope.capture()
+#   async for (timestamp,data) in scope.frames(100):
+#       ...
+#   await scope.close()
+
+
+# Output queue that is filled from a thread and emptied from an event loop.
+# The thread side has the queue.Queue methods the worker uses, the loop side
+# awaits get().
+class LoopQueue:
+    def __init__(self, loop, maxsize=0):
+        self.loop = loop
+        self.maxsize = maxsize
+        self._items = deque()
+        self._condition = threading.Condition()
+        # Futures of the coroutines waiting in get(), only touched in the loop
+        self._waiters = deque()
+
+    # Thread side
+
+    def put(self, item, block=True, timeout=None):
+        with self._condition:
+            while self.maxsize > 0 and len(self._items) >= self.maxsize:
+                if not block or not self._condition.wait(timeout):
+                    raise Full
+            self._items.append(item)
+        self._notify()
+
+    # Wakes up the coroutines waiting in get(). Nobody waits on a closed
+    # loop anymore, the item just stays queued.
+    def _notify(self):
+        if self.loop.is_closed():
+            return
+        try:
+            self.loop.call_soon_threadsafe(self._wakeup)
+        except RuntimeError:
+            # Closed since the check
+            pass
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get_nowait(self):
+        with self._condition:
+            if not self._items:
+                raise Empty
+            item = self._items.popleft()
+            # Room for a blocked put
+            self._condition.notify()
+        return item
+
+    def qsize(self):
+        return len(self._items)
+
+    def empty(self):
+        return not self._items
+
+    # Loop side
+
+    def _wakeup(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def get(self):
+        while True:
+            try:
+                return self.get_nowait()
+            except Empty:
+                pass
+            waiter = self.loop.create_future()
+            self._waiters.append(waiter)
+            await waiter
+
+
+class AsyncScope(Scope):
+    # Same arguments as Scope. Opening the scope blocks, use open() to do
+    # that in an executor instead. Outside of a coroutine the event loop
+    # that will use the scope has to be passed as loop.
+    def __init__(self, *args, loop=None, **kwargs):
+        if loop is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                raise Exception("AsyncScope needs a running event loop, or pass one as loop")
+        self.loop = loop
+        # Only one request/reply exchange with the worker at a time
+        self._lock = asyncio.Lock()
+        Scope.__init__(self, *args, **kwargs)
+
+    @classmethod
+    async def open(cls, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, lambda: cls(*args, loop=loop, **kwargs))
+
+    def _new_out_queue(self):
+        return LoopQueue(self.loop, 10)
+
+    async def _request(self, cmd, args=[]):
+        async with self._lock:
+            return await self._exchange(cmd, args)
+
+    async def _exchange(self, cmd, args=[]):
+        self.cmdQueue.put([cmd,args])
+        item = await self.outQueue.get()
+        if isinstance(item,ScopeError):
+            raise item
+        return item
+
+    # Changes any of the settings and waits until the worker applied them.
+    # voltage, coupling and channelOn are {channel: value} dicts, the channels
+    # in them are reconfigured. trg is (triggerType,triggerChannel,triggerExtra).
+    # In continuous mode the settings are applied between frames and this
+    # doesn't wait for them.
+    async def configure(self, timebase=None, voltage={}, coupling={}, channelOn={},
+            trg_pre=None, trg_suf=None, trg=None, trg_edge_level=None, timeout=None):
+        if timeout is not None:
+            self.timeout = timeout
+        channels = set()
+        for (channel,value) in voltage.items():
+            self.setVoltage(channel,value)
+            channels.add(channel)
+        for (channel,value) in coupling.items():
+            self.setCoupling(channel,value)
+            channels.add(channel)
+        for (channel,value) in channelOn.items():
+            self.channel_on(channel,value)
+            channels.add(channel)
+        for channel in sorted(channels):
+            self.configure_channel(channel)
+        if timebase is not None:
+            self.configure_timebase(timebase)
+        if trg_pre is not None:
+            self.configure_trg_pre(trg_pre)
+        if trg_suf is not None:
+            self.configure_trg_suf(trg_suf)
+        if trg is not None:
+            self.configure_trg(*trg)
+        if trg_edge_level is not None:
+            self.configure_trg_edge_level(trg_edge_level)
+
+        if not self.continuous:
+            await self._request('sync')
+
+    async def sync(self):
+        await self._request('sync')
+
+    async def capture_start(self):
+        if self.continuous:
+            return [ [],[] ]
+        return await self._request('capture_start')
+
+    async def arm(self):
+        return await self.capture_start()
+
+    async def get_data(self):
+        if self.continuous:
+            return (await self.read_frame())[1]
+        return self._unpack(await self._request('get_data'))[1]
+
+    # Arms the scope and returns the data of the capture
+    async def capture(self):
+        if self.continuous:
+            return await self.get_data()
+        # Keep other coroutines from arming in between
+        async with self._lock:
+            await self._exchange('capture_start')
+            return self._unpack(await self._exchange('get_data'))[1]
+
+    async def capture_many(self, n, dtype='int8'):
+        if self.continuous:
+            raise Exception("capture_many is not available in continuous mode")
+        return await self._request('capture_many', [n,dtype])
+
+    async def autoset(self, channel=0):
+        if self.continuous:
+            raise Exception("autoset is not available in continuous mode")
+        return await self._request('autoset', [channel])
+
+    async def reconnect(self):
+        if self.continuous:
+            self.cmdQueue.put(['reconnect',[]])
+            return None
+        return await self._request('reconnect')
+
+    async def read_frame(self, timeout=None):
+        try:
+            item = await asyncio.wait_for(self.outQueue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        return self._unpack(item)
+
+    # Async iterator over (timestamp,data) of count frames (forever if None)
+    # from the continuous mode, which is stopped again afterwards.
+    async def frames(self, count=None):
+        wasContinuous = self.continuous
+        if not wasContinuous:
+            self.start_continuous()
+        try:
+            n = 0
+            while count is None or n < count:
+                yield await self.read_frame()
+                n += 1
+        finally:
+            if not wasContinuous:
+                await self.stop_continuous()
+
+    async def stop_continuous(self):
+        if not self.continuous:
+            return
+        self.cmdQueue.put(['stop_continuous',[]])
+        # Throw away the frames that were still on their way
+        while True:
+            item = await self.outQueue.get()
+            if isinstance(item,str) and item == self.STOPPED:
+                break
+            if not isinstance(item,ScopeError):
+                self._discard(item)
+        self.continuous = False
+
+    async def close(self):
+        await self.stop_continuous()
+        Scope.close(self)
+        await self.loop.run_in_executor(None, self.thread.join)
@@ -0,0 +1,214 @@
+import numpy as np
+from vds1022 import VDS1022
+
+# Picks the voltage, timebase and trigger of a channel with as few captures
+# as possible:
+#
+#   result = Autoset(vds, Scope.timebaseValues, channel=0).run()
+#   print(result['captures'], result['voltage'], hex(result['timebase']))
+#
+# The voltage (an index into VDS1022.vdivs) is searched on the raw int8
+# samples: a clipped capture moves the search up, one that isn't clipped
+# tells the peak voltage, from which the voltage that fits it is predicted
+# and only checked with one more capture. Falls back to bisection when a
+# prediction is off. The period comes from the rising crossings of the
+# middle level, the timebase is then the fastest of timebases (timebase
+# register values, slowest last) that still shows TARGET_PERIODS periods.
+# The trigger is a rising edge on the middle level. The scope is left
+# configured with what was picked.
+
+# Raw samples at or beyond this many counts from 0 are taken as clipped
+CLIP_COUNT = 126
+# Part of the range the peak may use at the picked voltage
+HEADROOM = 0.8
+# A signal with a smaller swing (in counts) has no period to speak of
+MIN_SWING = 8
+# Hysteresis of the crossings and the trigger, as part of the swing
+HYSTERESIS = 0.1
+# Periods shorter than this many samples aren't trusted (aliasing)
+MIN_PERIOD_SAMPLES = 16
+# Periods a record should show at the picked timebase
+TARGET_PERIODS = 4
+# Timebase of the voltage search, 10ms of record at the default length
+START_TIMEBASE = 0xc0
+MAX_CAPTURES = 16
+
+class Autoset:
+    def __init__(self, vds, timebases, channel=0, maxCaptures=MAX_CAPTURES):
+        self.vds = vds
+        self.timebases = list(timebases)
+        self.channel = channel
+        self.maxCaptures = maxCaptures
+        self.captures = 0
+
+    # One capture of the channel at the current settings, raw int8 samples.
+    # The trigger is forced right away, the signal is unknown still.
+    def capture(self):
+        if self.captures >= self.maxCaptures:
+            raise Exception("autoset gave up after %d captures" % self.captures)
+        self.captures += 1
+        (out, timing) = self.vds.capture_many(1, timeout=0)
+        channels = [ i for i in range(2) if self.vds.channelOn[i] ]
+        return out[0, channels.index(self.channel)]
+
+    def set_voltage(self, voltage):
+        if self.vds.voltage[self.channel] != voltage:
+            self.vds.voltage[self.channel] = voltage
+            self.vds.configure_channel(self.channel)
+
+    def set_timebase(self, timebase):
+        if self.vds.timebase != timebase:
+            self.vds.configure_timebase(timebase)
+
+    @staticmethod
+    def clipped(raw):
+        return bool(raw.max() >= CLIP_COUNT or raw.min() <= -CLIP_COUNT - 1)
+
+    # Largest distance from the zero level in volts
+    def peak_volts(self, raw, voltage):
+        counts = raw.astype(np.float64) - self.vds.zero_offset(self.channel, voltage)
+        return float(np.abs(counts).max()) * VDS1022.volts_per_count(voltage)
+
+    # The smallest voltage with the peak within HEADROOM of its range
+    @staticmethod
+    def fitting_voltage(peak):
+        for voltage in range(len(VDS1022.vdivs)):
+            if peak <= VDS1022.volts_per_count(voltage) * CLIP_COUNT * HEADROOM:
+                return voltage
+        return len(VDS1022.vdivs) - 1
+
+    # Returns (voltage, raw, clipped): the voltage, the capture at it and
+    # whether even the largest voltage clipped.
+    def search_voltage(self):
+        lo = 0
+        hi = len(VDS1022.vdivs) - 1
+        # Start at the top, a capture that doesn't clip predicts the rest
+        guess = hi
+        best = None
+        last = None
+        while lo <= hi:
+            voltage = guess if guess is not None else (lo + hi) // 2
+            guess = None
+            self.set_voltage(voltage)
+            raw = self.capture()
+            last = (voltage, raw)
+            if self.clipped(raw):
+                lo = voltage + 1
+                continue
+            fit = self.fitting_voltage(self.peak_volts(raw, voltage))
+            if fit == voltage:
+                # The prediction held
+                best = (voltage, raw)
+                break
+            if fit < voltage:
+                best = (voltage, raw)
+                hi = voltage - 1
+            else:
+                lo = voltage + 1
+            if lo <= fit <= hi:
+                guess = fit
+
+        if best is None:
+            # Too big for the largest voltage
+            best = last
+        self.set_voltage(best[0])
+        return (best[0], best[1], self.clipped(best[1]))
+
+    # Returns (period in samples or None, swing, middle level) of raw
+    @staticmethod
+    def estimate_period(raw):
+        counts = raw.astype(np.float64)
+        high = counts.max()
+        low = counts.min()
+        swing = high - low
+        middle = (high + low) / 2
+        if swing < MIN_SWING:
+            return (None, swing, middle)
+
+        # Rising crossings: above the upper threshold after being below the lower one
+        above = counts > middle + swing * HYSTERESIS
+        below = counts < middle - swing * HYSTERESIS
+        index = np.flatnonzero(above | below)
+        state = above[index]
+        rising = index[1:][state[1:] & ~state[:-1]]
+        if len(rising) < 2:
+            return (None, swing, middle)
+        return ((rising[-1] - rising[0]) / (len(rising) - 1), swing, middle)
+
+    # Index of the fastest timebase with TARGET_PERIODS periods in the record
+    def target_timebase(self, period):
+        needed = TARGET_PERIODS * period * self.vds.SAMPLE_CLOCK / self.vds.samples_per_channel()
+        for (i,timebase) in enumerate(self.timebases):
+            if timebase >= needed:
+                return i
+        return len(self.timebases) - 1
+
+    def run(self):
+        vds = self.vds
+        channel = self.channel
+        if not vds.channelOn[channel]:
+            vds.channelOn[channel] = True
+            vds.configure_channel(channel)
+
+        timebases = self.timebases
+        position = min(range(len(timebases)), key=lambda i: abs(timebases[i] - START_TIMEBASE))
+        self.set_timebase(timebases[position])
+        (voltage, raw, clipped) = self.search_voltage()
+
+        # Find a timebase that shows whole periods, in steps of 4x, then
+        # measure again at the one showing TARGET_PERIODS: a period that
+        # doesn't hold there was an alias of a faster signal.
+        confirmed = set()
+        while True:
+            (period, swing, middle) = self.estimate_period(raw)
+            if swing < MIN_SWING:
+                # DC, or nothing connected
+                break
+            if period is None and position < len(timebases) - 1:
+                position = min(position + 2, len(timebases) - 1)
+            elif period is not None and period < MIN_PERIOD_SAMPLES and position > 0:
+                position = max(position - 2, 0)
+            elif period is not None:
+                confirmed.add(position)
+                target = self.target_timebase(period * vds.timebase / vds.SAMPLE_CLOCK)
+                if target in confirmed:
+                    break
+                position = target
+            else:
+                break
+            self.set_timebase(timebases[position])
+            raw = self.capture()
+            if self.clipped(raw) and voltage < len(VDS1022.vdivs) - 1:
+                # Peaks the search's timebase missed. The clipped peak is
+                # only a lower bound, so at least one voltage up.
+                voltage = max(voltage + 1, self.fitting_voltage(self.peak_volts(raw, voltage)))
+                self.set_voltage(voltage)
+                raw = self.capture()
+            clipped = self.clipped(raw)
+
+        periodSeconds = None
+        if period is not None:
+            periodSeconds = float(period * vds.timebase / vds.SAMPLE_CLOCK)
+            self.set_timebase(timebases[self.target_timebase(periodSeconds)])
+
+        # Rising edge at the middle of the signal
+        level = int(round(middle))
+        hysteresis = max(1, int(round(swing * HYSTERESIS / 2)))
+        vds.configure_trg(0, channel, 0)
+        vds.configure_trg_edge_level(VDS1022.edge_level(level, hysteresis), channel)
+
+        return {
+                'channel': channel,
+                'voltage': voltage,
+                'timebase': vds.timebase,
+                'period': periodSeconds,
+                'frequency': 1 / periodSeconds if periodSeconds else None,
+                'level': level,
+                'levelVolts': float((level - vds.zero_offset(channel)) * VDS1022.volts_per_count(voltage)),
+                'clipped': clipped,
+                'captures': self.captures,
+            }
+
+
+def autoset(vds, timebases, channel=0, maxCaptures=MAX_CAPTURES):
+    return Autoset(vds, timebases, channel, maxCaptures).run()
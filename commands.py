@@ -106,6 +106,35 @@ class Commands:
         AddressAttachCommand("LED_CONTROL", 0x1006, 1),
     ]
 
+    # These addresses trigger an action or report state instead of holding a
+    # setting, writing the same value twice is not a no-op for them.
+    volatile = [
+        "FPGA_DOWNLOAD_ADD",
+        "MACHINE_TYPE_ADD",
+        "FPGA_DOWNLOAD_QUERY_ADD",
+        "read_flash",
+        "write_flash",
+        "trg_d_ADD",
+        "TRG_D_ADD",
+        "VIDEOTRGD_ADD",
+        "datafinished_ADD",
+        "FORCETRG_ADD",
+        "PREGET_SLOW_ADD",
+        "EMPTY_ADD",
+        "edge_level_ext_ADD",
+        "GETDATA_ADD",
+        "GETDATA2_ADD",
+        "RE_COLLECT",
+        "CHECK_STOP_ADD",
+        "RUNSTOP_ADD",
+        "PF_ADD",
+        "ADD_CH1_FreqRef",
+        "ADD_CH2_FreqRef",
+        "ADC_RESET",
+        "reset_adc_0x22",
+        "READBACK_HTRG_OFFSET",
+    ]
+
     def __init__(self):
         pass
 
@@ -114,11 +143,103 @@ class Commands:
             if cmd.name == commandName:
                 return cmd
         return None
-     
+
+    # Names of the commands whose register covers address, as (name,offset)
+    # with the offset of address into the register. Aliases are all listed.
+    def lookup(self,address):
+        ret = []
+        for cmd in self.commands:
+            if cmd.address <= address < cmd.address + cmd.length:
+                if (cmd.name,address - cmd.address) not in ret:
+                    ret.append((cmd.name,address - cmd.address))
+        return ret
+
     def printSortedCommands(self):
         for cmd in sorted(self.commands,key=lambda x: x.address):
             print("address",hex(cmd.address),"CMD",cmd.name,"lenght:",cmd.length)
 
+
+# Packets writing length bytes at address. The header and value are packed
+# by one precompiled struct.Struct, values are truncated to the width. The
+# buffer pack_buffer() reuses makes an encoder usable by one writer only,
+# every VDS1022 keeps its own (see VDS1022._encoder).
+class PacketEncoder:
+    FORMATS = { 1: '<IBB', 2: '<IBH', 4: '<IBI' }
+
+    def __init__(self,address,length):
+        self.address = address
+        self.length = length
+        self.mask = (1 << (8 * length)) - 1
+        fmt = self.FORMATS.get(length)
+        if fmt is None:
+            # Odd widths carry the value as little endian bytes
+            fmt = '<IB%ds' % length
+            self._value = lambda value: (value & self.mask).to_bytes(length,'little')
+        else:
+            self._value = lambda value: value & self.mask
+        self.struct = struct.Struct(fmt)
+        self.buffer = bytearray(self.struct.size)
+
+    # A new packet, for when it is kept around (e.g. queued in a batch)
+    def pack(self,value):
+        return self.struct.pack(self.address,self.length,self._value(value))
+
+    # The packet in the buffer of this encoder, valid until the next call
+    def pack_buffer(self,value):
+        self.struct.pack_into(self.buffer,0,self.address,self.length,self._value(value))
+        return self.buffer
+
+
+class Register:
+    def __init__(self,command,volatile):
+        self.command = command
+        self.name = command.name
+        self.address = command.address
+        self.length = command.length
+        # Triggers an action or reports state, see Commands.volatile
+        self.volatile = volatile
+
+
+# The commands table as registers, looked up by name or by address.
+# Duplicate entries and aliases (same address and width) share a Register,
+# which is volatile when any of its names is.
+class RegisterMap:
+    def __init__(self,commands):
+        self.byName = {}
+        self.byAddress = {}
+        for cmd in commands.commands:
+            if cmd.name in self.byName:
+                continue
+            volatile = cmd.name in commands.volatile
+            register = self.byAddress.get(cmd.address)
+            if register is not None and register.length == cmd.length:
+                register.volatile = register.volatile or volatile
+            else:
+                register = Register(cmd, volatile)
+                self.byAddress.setdefault(cmd.address,register)
+            self.byName[cmd.name] = register
+
+    # name or address
+    def __getitem__(self,key):
+        if isinstance(key,str):
+            return self.byName[key]
+        return self.byAddress[key]
+
+    # All byte addresses that hold a setting, i.e. the ones it is safe to
+    # remember the last written value of.
+    def setting_addresses(self):
+        registers = set()
+        volatile = set()
+        for register in self.byName.values():
+            span = range(register.address, register.address + register.length)
+            if register.volatile:
+                volatile.update(span)
+            else:
+                registers.update(span)
+        return registers - volatile
+
+REGISTERS = RegisterMap(Commands)
+
 if __name__== "__main__":
     cmd = Commands()
     cmd.printSortedCommands()
@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+# Software emulation of the VDS1022 USB protocol.
+#
+# EmulatedVDS1022 is a transport (see vds1022.UsbTransport) that answers the
+# commands the way the scope does, so the driver, Scope, run.py style scripts
+# and benchmarks can run without hardware:
+#
+#   from vds1022 import VDS1022
+#   from emulator import EmulatedVDS1022
+#   scope = VDS1022(transport=EmulatedVDS1022())
+#
+# Running this file benchmarks the driver against the emulator.
+import struct,time,math,sys
+from collections import deque
+import numpy as np
+
+# Sine wave, amplitude in ADC counts
+def sine(amplitude=100, frequency=1e3, offset=0, phase=0):
+    def waveform(t):
+        return offset + amplitude * np.sin(2 * math.pi * frequency * t + phase)
+    return waveform
+
+# Square wave, amplitude in ADC counts
+def square(amplitude=100, frequency=1e3, offset=0):
+    def waveform(t):
+        return offset + amplitude * np.where((t * frequency) % 1.0 < 0.5, 1.0, -1.0)
+    return waveform
+
+def noise(amplitude=2):
+    def waveform(t):
+        return np.random.normal(0, amplitude, len(t))
+    return waveform
+
+# How long the emulated device takes for a transfer: a fixed turnaround plus
+# the time to move the bytes. The defaults are roughly USB 2.0 high speed.
+class LatencyModel:
+    def __init__(self, turnaround=125e-6, bytesPerSecond=30e6):
+        self.turnaround = turnaround
+        self.bytesPerSecond = bytesPerSecond
+
+    def __call__(self, length):
+        return self.turnaround + length / self.bytesPerSecond
+
+
+class EmulatedVDS1022:
+    # The emulator has no libusb transfers, VDS1022.frames reads in turn
+    supportsAsync = False
+
+    SAMPLE_CLOCK = 100e6
+    FLASH_LENGTH = 2002
+    # Samples after the 11 byte header of a data packet: the trigger buffer
+    # and the record, which is the dm register long
+    TRIGGER_BUFFER = 100
+    DEFAULT_RECORD_LENGTH = 0x13ec
+    # Where the trigger point sits in the samples of a packet
+    TRIGGER_INDEX = 100 + 50
+
+    # waveforms: one function per channel taking the sample times (seconds
+    #   relative to the trigger) and returning ADC counts, or volts with
+    #   units='volts'
+    # units: 'counts', or 'volts' to have the channel voltage scale the
+    #   waveforms like the real input does. The voltage is the one the volt
+    #   gain register held when the capture was started.
+    # latency: None for no delays, or a function of the transfer length
+    #   returning seconds, e.g. a LatencyModel
+    # triggerDelay: seconds from arming until the trigger fires, None for a
+    #   trigger that never comes (only force_trigger ends the capture)
+    # timeScale: factor on the emulated acquisition time, 0 makes it instant
+    # maxTransfer: most bytes a read returns (a multiple of 512), longer
+    #   packets have to be read in pieces. None for no limit.
+    def __init__(self,
+            waveforms=None,
+            latency=None,
+            triggerDelay=0.0,
+            timeScale=1.0,
+            bitstreamLoaded=False,
+            serial='EMU00001',
+            calibration=None,
+            bufferSize=64 * 1024,
+            maxTransfer=None,
+            units='counts',
+        ):
+        if waveforms is None:
+            waveforms = [ sine(100, 1e3), square(50, 2e3) ]
+        self.waveforms = waveforms
+        self.latency = latency
+        self.triggerDelay = triggerDelay
+        self.timeScale = timeScale
+        self.bitstreamLoaded = bitstreamLoaded
+        self.serial = serial
+        self.bufferSize = bufferSize
+        self.maxTransfer = maxTransfer
+        self.units = units
+
+        if calibration is None:
+            # gain, amplitude, compensation for 2 channels and 10 voltages.
+            # The gains differ per voltage, see _voltage
+            gains = [ 0x1c0 + voltage for voltage in range(10) ]
+            calibration = [ [ list(values) for channel in range(2) ] for values in (gains, [0x5a] * 10, [0x1f4] * 10) ]
+        self.calibration = calibration
+        self.flash = self._make_flash(calibration)
+
+        self.registers = {}
+        self._responses = deque()
+        self._uploadChunks = 0
+        self._armedAt = None
+        self._doneAt = None
+        # Channel voltages the running capture was started with
+        self._armedVoltage = [0, 0]
+        self.sequence = 0
+        self.closed = False
+        self.plugged = True
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.writes = 0
+        self.reads = 0
+        self.bytesWritten = 0
+        self.bytesRead = 0
+        self.captures = 0
+        self.forcedTriggers = 0
+
+    def counters(self):
+        return {
+                'writes': self.writes,
+                'reads': self.reads,
+                'bytesWritten': self.bytesWritten,
+                'bytesRead': self.bytesRead,
+                'captures': self.captures,
+                'forcedTriggers': self.forcedTriggers,
+            }
+
+    def _make_flash(self, calibration):
+        flash = bytearray(self.FLASH_LENGTH)
+        flash[0:2] = b'\xaa\x55'
+        struct.pack_into('<I', flash, 2, 2)
+        values = np.array(calibration, dtype='<u2').reshape(-1)
+        flash[6:6 + 2 * len(values)] = values.tobytes()
+        return bytes(flash)
+
+    def _delay(self, length):
+        if self.latency is not None:
+            time.sleep(self.latency(length))
+
+    def _respond(self, code, value):
+        self._responses.append(code.encode() + struct.pack('<I', value & 0xffFFffFF))
+
+    # Transport interface
+
+    def write(self, buf):
+        if self.closed:
+            raise Exception("emulated device is closed")
+        buf = bytes(buf)
+        self.writes += 1
+        self.bytesWritten += len(buf)
+        self._delay(len(buf))
+
+        if self._uploadChunks > 0:
+            # Bitstream chunk: transfer ID followed by the data
+            self._respond('S', struct.unpack('<I', buf[0:4])[0])
+            self._uploadChunks -= 1
+            if self._uploadChunks == 0:
+                self.bitstreamLoaded = True
+                self.registers = {}
+            return
+
+        (address, length) = struct.unpack('<IB', buf[0:5])
+        value = int.from_bytes(buf[5:5 + length], 'little')
+        self._command(address, length, value)
+
+    def read(self, length):
+        if self.closed:
+            raise Exception("emulated device is closed")
+        if not self._responses:
+            # The real device would time out
+            raise Exception("emulated device has nothing to send")
+        response = self._responses.popleft()
+        if self.maxTransfer is not None:
+            length = min(length, self.maxTransfer)
+        ret = response[:length]
+        if len(response) > length:
+            # The rest comes with the next read
+            self._responses.appendleft(response[length:])
+        self.reads += 1
+        self.bytesRead += len(ret)
+        self._delay(len(ret))
+        return ret
+
+    def read_into(self, dest):
+        ret = self.read(len(dest))
+        dest[:len(ret)] = np.frombuffer(ret, np.int8)
+        return len(ret)
+
+    def identity(self):
+        return 'serial:' + self.serial
+
+    def reopen(self):
+        if not self.plugged:
+            raise Exception("emulated device is not plugged in")
+        self._responses.clear()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    # Failures to test recovery with
+
+    # The scope resets: the FPGA loses its bitstream and the registers
+    def power_cycle(self):
+        self.bitstreamLoaded = False
+        self.registers = {}
+        self._responses.clear()
+        self._armedAt = None
+        self._doneAt = None
+
+    # The USB cable is pulled, which also powers the scope down. The open
+    # handle stays dead until reopen()
+    def unplug(self):
+        self.plugged = False
+        self.closed = True
+        self.power_cycle()
+
+    def plug(self):
+        self.plugged = True
+
+    # Emulated device
+
+    def _command(self, address, length, value):
+        if address == 0x4001: # MACHINE_TYPE_ADD
+            self._respond('V', 1)
+        elif address == 547: # FPGA_DOWNLOAD_QUERY_ADD
+            self._respond('E', 1 if self.bitstreamLoaded else 0)
+        elif address == 0x4000: # FPGA_DOWNLOAD_ADD, value is the bitstream size
+            self._uploadChunks = (value + self.bufferSize - 5) // (self.bufferSize - 4)
+            self.bitstreamLoaded = False
+            self._respond('D', self.bufferSize)
+        elif address == 432: # read_flash
+            self._responses.append(self.flash)
+        elif address == 0x1000: # GETDATA_ADD
+            self._send_data(value)
+        else:
+            if address == 0x10c and value == 1: # capture start
+                self._arm()
+            elif address == 0xc: # FORCETRG_ADD
+                if self._armedAt is not None:
+                    now = time.time()
+                    self._doneAt = now if self._doneAt is None else min(self._doneAt, now)
+                    self.forcedTriggers += 1
+            elif address == 0x7a: # datafinished_ADD
+                self._respond('S', 1 if self._ready() else 0)
+                return
+            else:
+                for i in range(length):
+                    self.registers[address + i] = (value >> (8 * i)) & 0xff
+            self._respond('S', 0)
+
+    def _register(self, address, length=1):
+        return sum(self.registers.get(address + i, 0) << (8 * i) for i in range(length))
+
+    def timebase(self):
+        return self._register(0x52, 4) or 1
+
+    # Time to fill the pre and post trigger buffers
+    def _acquisition_time(self):
+        samples = self._register(0x56, 2) + self._register(0x5a, 2)
+        return self.timeScale * samples * self.timebase() / self.SAMPLE_CLOCK
+
+    # Voltage index of channel, found from the gain the driver wrote
+    def _voltage(self, channel):
+        gain = self._register((278, 276)[channel], 2) # volt_gain_ch1/2_ADD
+        gains = self.calibration[0][channel]
+        return gains.index(gain) if gain in gains else 0
+
+    def _arm(self):
+        now = time.time()
+        self._armedAt = now
+        self._armedVoltage = [ self._voltage(channel) for channel in range(2) ]
+        if self.triggerDelay is None:
+            self._doneAt = None
+        else:
+            self._doneAt = now + self.timeScale * self.triggerDelay + self._acquisition_time()
+
+    def _ready(self):
+        if self._doneAt is None:
+            # Never armed, or waiting for a trigger that doesn't come
+            return False
+        return time.time() >= self._doneAt
+
+    def _send_data(self, value):
+        chlOn = self._register(0xb)
+        if value == 0x0505:
+            channels = [0, 1]
+        else:
+            channels = [ i for i in range(2) if chlOn & (1 << i) ][:1]
+
+        self.captures += 1
+        self.sequence += 1
+        period = self.timebase() / self.SAMPLE_CLOCK
+        samples = self.TRIGGER_BUFFER + (self._register(0x5c, 2) or self.DEFAULT_RECORD_LENGTH)
+        t = (np.arange(samples) - self.TRIGGER_INDEX) * period
+        t += self.sequence * 1e-3 # so the free running waveforms move a bit
+        for channel in channels:
+            values = self.waveforms[channel](t)
+            if self.units == 'volts':
+                from vds1022 import VDS1022
+                values = values / VDS1022.volts_per_count(self._armedVoltage[channel])
+            samples = np.clip(np.round(values), -128, 127).astype(np.int8)
+            header = bytes([channel]) + bytes(10)
+            self._responses.append(header + samples.tobytes())
+
+
+# Measures the driver against the emulator: frames per second, USB
+# transactions per frame and CPU time per frame.
+def benchmark(captures=200, channels=(True,False), latency=None, timebase=0x1):
+    from vds1022 import VDS1022
+
+    device = EmulatedVDS1022(latency=latency, timeScale=0, bitstreamLoaded=True)
+    vds = VDS1022(channelOn=list(channels), timebase=timebase, verbose=False, transport=device)
+    vds.capture_init()
+    device.reset_counters()
+
+    start = time.time()
+    cpuStart = time.process_time()
+    for data in vds.frames(captures):
+        pass
+    duration = time.time() - start
+    cpu = time.process_time() - cpuStart
+
+    counters = device.counters()
+    return {
+            'captures': captures,
+            'duration': duration,
+            'framesPerSecond': captures / duration if duration > 0 else 0.0,
+            'transactionsPerFrame': (counters['writes'] + counters['reads']) / captures,
+            'bytesPerFrame': (counters['bytesWritten'] + counters['bytesRead']) / captures,
+            'cpuPerFrame': cpu / captures,
+        }
+
+if __name__ == "__main__":
+    captures = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    for (name, latency) in [('no latency', None), ('usb latency', LatencyModel())]:
+        for channels in [(True,False), (True,True)]:
+            result = benchmark(captures, channels, latency)
+            print("%-12s channels %-13s %8.1f frames/s %5.1f transactions/frame %8.0f bytes/frame %6.3f ms cpu/frame" % (
+                name, channels, result['framesPerSecond'], result['transactionsPerFrame'],
+                result['bytesPerFrame'], result['cpuPerFrame'] * 1000))
@@ -244,6 +244,7 @@ class TestWindow(QMainWindow):
 
         for i in [0,1]:
             params = self.channels[i].getParams() 
+            scope.channel_on(i,params['on'])
             scope.setVoltage(i,params['voltage'])
             scope.setCoupling(i,params['coupling'])
 
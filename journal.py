@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+# Binary journal of the USB traffic of a VDS1022.
+#
+# Every write and read is appended as a record to a buffered file, which is
+# cheap enough to leave on in production (unlike VDS1022.debug, which prints
+# every byte). The journal is analysed afterwards:
+#
+#   scope = VDS1022(journal='session.vdsj')
+#   ...
+#   scope.close()
+#
+#   python3 journal.py session.vdsj
+#
+# File layout: MAGIC, a '<H' version, then the records. A record is a
+# RECORD header (timestamp, direction, endpoint, payload length) followed by
+# the payload.
+import struct,time,sys
+from collections import namedtuple
+from commands import Commands
+
+MAGIC = b'VDSJ'
+VERSION = 1
+HEADER = struct.Struct('<4sH')
+RECORD = struct.Struct('<dcBI')
+
+WRITE = b'W'
+READ = b'R'
+
+Record = namedtuple('Record', ['timestamp','direction','endpoint','payload'])
+
+class JournalWriter:
+    def __init__(self, path, bufferSize=1 << 20):
+        self.path = path
+        self.file = open(path, 'wb', buffering=bufferSize)
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.records = 0
+
+    # payload is anything with the buffer protocol (bytes, numpy arrays)
+    def record(self, direction, endpoint, payload):
+        payload = memoryview(payload).cast('B')
+        self.file.write(RECORD.pack(time.time(), direction, endpoint, len(payload)))
+        self.file.write(payload)
+        self.records += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# Yields the Records in the journal at path
+def read_journal(path):
+    with open(path, 'rb') as f:
+        (magic, version) = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise Exception("%s is not a journal" % path)
+        if version != VERSION:
+            raise Exception("unsupported journal version %d" % version)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                # The end, or a record cut short when the program died
+                break
+            (timestamp, direction, endpoint, length) = RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                break
+            yield Record(timestamp, direction, endpoint, payload)
+
+
+# Turns records into readable text, naming the registers with the
+# commands.Commands table
+class Decoder:
+    RESPONSE_LENGTH = 5
+
+    def __init__(self, commands=None):
+        self.commands = commands if commands is not None else Commands()
+        self._names = {}
+
+    def name(self, address):
+        name = self._names.get(address)
+        if name is None:
+            found = self.commands.lookup(address)
+            # Prefer the registers that start here over the wider ones covering it
+            exact = [ (n,offset) for (n,offset) in found if offset == 0 ]
+            if exact:
+                found = exact
+            if found:
+                name = '/'.join(n if offset == 0 else '%s+%d' % (n,offset) for (n,offset) in found)
+            else:
+                name = '0x%x' % address
+            self._names[address] = name
+        return name
+
+    def describe(self, record):
+        payload = record.payload
+        if record.direction == WRITE:
+            if len(payload) >= 5:
+                (address, length) = struct.unpack('<IB', payload[0:5])
+                if len(payload) == 5 + length:
+                    value = int.from_bytes(payload[5:], 'little')
+                    return 'write %s (0x%x) = 0x%x' % (self.name(address), address, value)
+            # Bitstream chunks and anything else that isn't a command
+            return 'write %d bytes' % len(payload)
+        else:
+            if len(payload) == self.RESPONSE_LENGTH:
+                return 'response %s 0x%x' % (chr(payload[0]), struct.unpack('<I', payload[1:])[0])
+            if len(payload) > self.RESPONSE_LENGTH and payload[0] < 2:
+                # Data packets start with the channel, their length
+                # depends on the record length
+                return 'data packet channel %d, %d bytes' % (payload[0], len(payload))
+            return 'read %d bytes' % len(payload)
+
+    # Yields (seconds since the first record, record, description)
+    def decode(self, records):
+        start = None
+        for record in records:
+            if start is None:
+                start = record.timestamp
+            yield (record.timestamp - start, record, self.describe(record))
+
+
+if __name__ == "__main__":
+    decoder = Decoder()
+    for (t, record, text) in decoder.decode(read_journal(sys.argv[1])):
+        print("%12.6f %s 0x%02x %s" % (t, record.direction.decode(), record.endpoint, text))
@@ -0,0 +1,98 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from vds1022 import VDS1022
+
+# Drives several VDS1022s from one process.
+#
+# The scopes are opened in parallel (so bitstream uploads after a power
+# cycle overlap), armed together and read in parallel. Captures come back as
+# one batch, in the order of the devices, with host timestamps per device:
+#
+#   pool = ScopePool()                 # every VDS1022 that is plugged in
+#   pool.capture_init()
+#   for (armed,ready,data) in pool.capture():
+#       ...
+
+class ScopePool:
+    # devices: list of device selectors (see UsbTransport), None for all
+    #   connected scopes
+    # transports: instead of devices, a list of transports to use (e.g.
+    #   emulators)
+    # settings: passed on to every VDS1022 (voltage, timebase, ...)
+    def __init__(self, devices=None, transports=None, **settings):
+        if transports is not None:
+            targets = [ {'transport': transport} for transport in transports ]
+        else:
+            if devices is None:
+                # By serial number where there is one, so a scope that is
+                # replugged can be told from the others
+                devices = [ d['serial'] or (d['bus'], d['address']) for d in VDS1022.list_devices() ]
+            targets = [ {'device': device} for device in devices ]
+        if len(targets) == 0:
+            raise Exception("No scopes to open")
+
+        self.executor = ThreadPoolExecutor(len(targets))
+
+        def open(target):
+            kwargs = dict(settings)
+            kwargs.update(target)
+            return VDS1022(**kwargs)
+
+        # Wait for all of them, so the ones that did open can be closed
+        # again when another one fails
+        futures = [ self.executor.submit(open, target) for target in targets ]
+        self.scopes = []
+        error = None
+        for future in futures:
+            try:
+                self.scopes.append(future.result())
+            except Exception as e:
+                error = error or e
+
+        # VDS1022 reports a failed start by closing its transport
+        failed = [ i for (i,scope) in enumerate(self.scopes) if scope.transport is None ]
+        if error is not None or failed:
+            self.close()
+            if error is not None:
+                raise error
+            raise Exception("Unable to open scope(s) %s" % failed)
+
+    def __len__(self):
+        return len(self.scopes)
+
+    # Calls func(scope) for every scope in parallel, returns the results in order
+    def each(self, func):
+        return list(self.executor.map(func, self.scopes))
+
+    def capture_init(self):
+        self.each(lambda scope: scope.capture_init())
+
+    # Starts a capture on all scopes, back to back from this thread so the
+    # scopes are armed as close together as the bus allows. Returns the host
+    # time each scope was armed at.
+    def arm(self):
+        armed = []
+        for scope in self.scopes:
+            scope.capture_start()
+            armed.append(scope.armed_at())
+        return armed
+
+    # Waits for the captures started by arm() and reads them in parallel.
+    # Returns a list with (armed,ready,data) for every scope: when it was
+    # armed, when its data was ready and the data as get_data returns it.
+    def collect(self, timeout=None):
+        def read(scope):
+            armed = scope.armed_at()
+            scope.wait_for_capture(timeout)
+            ready = time.time()
+            return (armed, ready, scope.get_data())
+        return self.each(read)
+
+    def capture(self, timeout=None):
+        self.arm()
+        return self.collect(timeout)
+
+    def close(self):
+        for scope in self.scopes:
+            scope.close()
+        self.executor.shutdown()
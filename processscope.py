@@ -0,0 +1,300 @@
+import multiprocessing,traceback,gc
+from multiprocessing import shared_memory
+from queue import Empty
+from collections import deque
+from vds1022 import VDS1022, FrameRing
+from scope import Scope, runThread
+
+# ProcessScope is a Scope whose worker runs in its own process, so the
+# USB servicing doesn't have to share the GIL with the GUI or analysis code.
+#
+# The captures go into a ring of raw frames in shared memory. Only the slot
+# index and a bit of metadata go through the output queue, the client
+# converts the slot to volts and hands it back through freeQueue.
+#
+# The worker process is started with 'spawn', so scripts using this need the
+# usual `if __name__ == "__main__":` guard. A transport can't be passed to
+# another process, pass something that makes one (transportFactory) instead.
+
+
+# Conversion side of a VDS1022 for the client process, the device itself is
+# in the worker. Uses the calibration the worker read from the scope.
+class _ClientVDS1022(VDS1022):
+    def __init__(self, voltage, coupling, channelOn, calibration_data):
+        self.voltage = voltage
+        self.configuredVoltage = voltage
+        self.coupling = coupling
+        self.channelOn = channelOn
+        self.calibration_data = calibration_data
+        self.record_length = VDS1022.DEFAULT_RECORD_LENGTH
+        self._luts = {}
+
+
+# Stands in for the Scope in the worker process, see runThread
+class _ProcessWorker(Scope):
+    def __init__(self, scope, timeout, keepalive, backpressure, outQueue, capacity, freeQueue, ring):
+        # Scope.__init__ would start another worker, only set up what runThread uses
+        self.scope = scope
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.continuous = False
+        # The client drains the queue before it closes, see ProcessScope.close
+        self.closing = False
+        self.outQueue = outQueue
+        self.capacity = capacity
+        self.freeQueue = freeQueue
+        self._ring = ring
+        self._free = deque(range(ring.slots))
+        self.set_backpressure(backpressure)
+        self.reset_queue_stats()
+
+    def _acquire_slot(self):
+        # Slots the client is done with
+        while True:
+            try:
+                self._free.append(self.freeQueue.get_nowait())
+            except Empty:
+                break
+        if not self._free and self.backpressure != 'block':
+            # Reuse the slot of the oldest frame the client didn't pick up yet
+            self._drop(1)
+        if not self._free:
+            self._free.append(self.freeQueue.get())
+        return self._free.popleft()
+
+    def _read(self, scope):
+        return scope.read_frame(self._ring, self._acquire_slot())
+
+    def _package(self, frame):
+        slot = frame.slot
+        return (frame.timestamp, {
+                'slot': slot,
+                'length': int(self._ring.lengths[slot]),
+                'sequence': frame.sequence,
+                'voltage': [ int(v) for v in self._ring.voltage[slot] ],
+                'channelOn': [ bool(v) for v in self._ring.valid[slot] ],
+                'delivered': self.framesDelivered,
+                'dropped': self.framesDropped,
+                'highWater': self.queueHighWater,
+            })
+
+    # Roll mode chunks are small, they go through the queue themselves
+    def _package_chunk(self, chunk):
+        (timestamp, data) = chunk
+        return (timestamp, {
+                'chunk': data,
+                'delivered': self.framesDelivered,
+                'dropped': self.framesDropped,
+                'highWater': self.queueHighWater,
+            })
+
+    def _discard(self, item):
+        if 'slot' in item[1]:
+            self._free.append(item[1]['slot'])
+
+    def _queue_capacity(self):
+        return self.capacity
+
+
+def runProcess(settings, transportFactory, timeout, keepalive, backpressure, cmdQueue, outQueue, capacity, freeQueue, shmName, slots, length):
+    # Spawned processes share the resource tracker of the client, which
+    # unlinks the shared memory when the client is done with it
+    shm = shared_memory.SharedMemory(name=shmName)
+
+    try:
+        transport = transportFactory() if transportFactory is not None else None
+        scope = VDS1022(*settings, transport=transport)
+        outQueue.put(('ready', scope.calibration_data))
+    except Exception as e:
+        print(traceback.format_exc())
+        outQueue.put(('failed', str(e)))
+        shm.close()
+        return
+
+    ring = FrameRing(slots, length=length, buffer=shm.buf)
+    worker = _ProcessWorker(scope, timeout, keepalive, backpressure, outQueue, capacity, freeQueue, ring)
+    try:
+        runThread(worker, cmdQueue, outQueue)
+    finally:
+        # The ring is a view on the shared memory, it has to go first
+        del ring, worker
+        gc.collect()
+        shm.close()
+
+
+class ProcessScope(Scope):
+    def __init__(self,
+            voltage=[7,1],
+            coupling=[0,0],
+            channelOn=[True,False],
+            timebase = 0x190,
+            trg_suf=5000,
+            trg_pre=0,
+            timeout=1,
+            verbose=True,
+            calibrationCache=None,
+            transportFactory=None,
+            backpressure='block',
+            slots=16,
+            keepalive=1.0,
+            recordLength=VDS1022.DEFAULT_RECORD_LENGTH,
+            maxRecordLength=None,
+            ):
+
+        self._timeout = timeout
+        self.keepalive = keepalive
+        self.process = None
+        self.continuous = False
+        self.set_backpressure(backpressure)
+        self.reset_queue_stats()
+
+        context = multiprocessing.get_context('spawn')
+        self.cmdQueue = context.Queue()
+        # multiprocessing queues don't tell their maxsize, it is kept here
+        self.capacity = 10
+        self.outQueue = context.Queue(self.capacity)
+        self.freeQueue = context.Queue()
+
+        # The shared memory has room for records up to maxRecordLength, the
+        # record length can change within that
+        if maxRecordLength is None:
+            maxRecordLength = recordLength
+        self._check_record_length(recordLength, VDS1022.MAX_RECORD_LENGTH)
+        self._check_record_length(maxRecordLength, VDS1022.MAX_RECORD_LENGTH)
+        self.maxRecordLength = maxRecordLength
+        length = VDS1022.FRAME_HEADER_LENGTH + VDS1022.TRIGGER_BUFFER_LENGTH + maxRecordLength
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * 2 * length)
+        self._ring = FrameRing(slots, length=length, buffer=self._shm.buf)
+
+        settings = (list(voltage), list(coupling), list(channelOn), timebase, trg_suf, trg_pre, verbose, calibrationCache)
+        self.process = context.Process(
+                target=runProcess,
+                args=(settings, transportFactory, timeout, keepalive, backpressure,
+                    self.cmdQueue, self.outQueue, self.capacity, self.freeQueue, self._shm.name, slots, length),
+                daemon=True,
+            )
+        self.process.start()
+
+        # Wait for the worker to open the scope
+        while True:
+            try:
+                (status, result) = self.outQueue.get(timeout=0.1)
+                break
+            except Empty:
+                if not self.process.is_alive():
+                    (status, result) = ('failed', 'the process died')
+                    break
+        if status != 'ready':
+            self.process.join()
+            self._release_shm()
+            raise Exception("Unable to start the scope process: %s" % result)
+
+        # Mirrors the settings of the VDS1022 in the worker, for the conversion
+        self.scope = _ClientVDS1022(list(voltage), list(coupling), list(channelOn), result)
+        self.configure_timebase(timebase)
+        self.configure_record_length(recordLength)
+
+    # The worker has its own copy of these, changes are sent over
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._timeout = value
+        self.cmdQueue.put(['timeout',[value]])
+
+    def set_keepalive(self,interval):
+        self.keepalive = interval
+        Scope.set_keepalive(self,interval)
+
+    @staticmethod
+    def _check_record_length(length, maximum):
+        if length < VDS1022.MIN_RECORD_LENGTH or length > maximum:
+            raise Exception("record length %d is not within %d..%d" % (length, VDS1022.MIN_RECORD_LENGTH, maximum))
+
+    def configure_record_length(self,length):
+        # Longer records don't fit the shared memory
+        self._check_record_length(length, self.maxRecordLength)
+        self.scope.record_length = length
+        Scope.configure_record_length(self,length)
+
+    def autoset(self,channel=0):
+        result = Scope.autoset(self,channel)
+        self.scope.channelOn[channel] = True
+        self.scope.voltage[channel] = result['voltage']
+        return result
+
+    def channel_on(self,channelIdx,on):
+        self.scope.channelOn[channelIdx] = on
+        self.cmdQueue.put(['channel_on',[channelIdx,on]])
+
+    def setVoltage(self,channelIdx,voltage):
+        self.scope.voltage[channelIdx] = voltage
+        self.cmdQueue.put(['voltage',[channelIdx,voltage]])
+
+    def setCoupling(self,channelIdx,coupling):
+        self.scope.coupling[channelIdx] = coupling
+        self.cmdQueue.put(['coupling',[channelIdx,coupling]])
+
+    # Frames arrive as slot numbers in the shared ring
+
+    def _unpack(self, item):
+        (timestamp, meta) = item
+        if 'chunk' in meta:
+            data = meta['chunk']
+        else:
+            data = self._unpack_slot(meta)
+
+        self.framesDelivered = meta['delivered']
+        self.framesDropped = meta['dropped']
+        self.queueHighWater = meta['highWater']
+        return (timestamp, data)
+
+    def _unpack_slot(self, meta):
+        slot = meta['slot']
+        try:
+            data = [ [],[] ]
+            for channel in range(2):
+                if meta['channelOn'][channel]:
+                    raw = self._ring.raw[slot, channel, VDS1022.FRAME_DATA_OFFSET:meta['length']]
+                    data[channel] = self.scope.convert(raw, channel, voltage=meta['voltage'][channel])
+        finally:
+            self.freeQueue.put(slot)
+        return data
+
+    def _discard(self, item):
+        if 'slot' in item[1]:
+            self.freeQueue.put(item[1]['slot'])
+
+    def _queue_capacity(self):
+        return self.capacity
+
+    # The statistics are kept by the worker process
+    def stats(self):
+        if self.continuous:
+            raise Exception("stats are not available in continuous mode")
+        self.cmdQueue.put(['stats',[]])
+        return self._reply()
+
+    def reset_stats(self):
+        self.cmdQueue.put(['reset_stats',[]])
+        self.reset_queue_stats()
+
+    def close(self):
+        if self.process is None:
+            return
+        # The worker could be waiting for us to take a frame
+        self.stop_continuous()
+        Scope.close(self)
+        self.process.join()
+        self.process = None
+        self._release_shm()
+
+    def _release_shm(self):
+        # The ring is a view on the shared memory, it has to go first
+        self._ring = None
+        gc.collect()
+        self._shm.close()
+        self._shm.unlink()
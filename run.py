@@ -1,5 +1,5 @@
 #!/usr/bin/python3
-from vds1022 import VDS1022,hexAscii,printBytes
+from vds1022 import VDS1022,printBytes
 from Trace import TraceSet,Trace 
 import sys
 
@@ -10,23 +10,18 @@ outputFile=sys.argv[1]
 ts = TraceSet()
 titleLen=0
 dataLen=0
-numSamples=5098
+numSamples=scope.samples_per_channel()
 ts.new(outputFile,titleLen,TraceSet.CodingFloat,dataLen,int(numSamples),[0,0])
 scope.capture_init()
+scope.configure_timebase(0xc)
 
 try:
-    for i in range(3):
-        scope.configure_timebase(0xc)
-        scope.capture_start()
-
-        while scope.get_data_ready() == 0:
-            pass
-
+    # Back to back, converted in one go afterwards
+    (data, timing) = scope.capture_many(3, dtype='float32')
+    for (i,segment) in enumerate(data):
         print('i',i)
-        data  = scope.get_data()
-
-        ts.addTrace(Trace('',[],data[0]))
-        #ts.addTrace(Trace('',[],data[1]))
+        ts.addTrace(Trace('',[],segment[0]))
+        #ts.addTrace(Trace('',[],segment[1]))
 except Exception as e:
     scope.close()
 
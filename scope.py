@@ -1,72 +1,343 @@
-from queue import Queue
+from queue import Queue, Empty, Full
 from threading import Thread
-from vds1022  import VDS1022 
-import time,traceback
+from vds1022  import VDS1022, FrameRing
+from autoset import autoset
+import time,traceback,json
+
+# Applies a configuration command, returns False for other commands
+def applyConfig(parent,scope,cmd,args):
+    if cmd == 'configure_timebase':
+        scope.configure_timebase(args[0])
+    elif cmd == 'configure_channel':
+        scope.configure_channel(args[0])
+    elif cmd == 'trg_pre':
+        scope.configure_trg_pre(args[0])
+    elif cmd == 'trg_suf':
+        scope.configure_trg_suf(args[0])
+    elif cmd == 'trg_edge_level':
+        scope.configure_trg_edge_level(args[0])
+    elif cmd == 'trg':
+        scope.configure_trg(args[0],args[1],args[2])
+    elif cmd == 'record_length':
+        scope.configure_record_length(args[0])
+    # Settings for when the scope object lives in another process
+    elif cmd == 'channel_on':
+        scope.channelOn[args[0]] = args[1]
+    elif cmd == 'voltage':
+        scope.voltage[args[0]] = args[1]
+    elif cmd == 'coupling':
+        scope.coupling[args[0]] = args[1]
+    elif cmd == 'timeout':
+        parent.timeout = args[0]
+    elif cmd == 'keepalive':
+        parent.keepalive = args[0]
+    else:
+        return False
+    return True
+
+# Configuration commands and the arguments that tell which setting they change
+CONFIG_COMMANDS = {
+    'configure_timebase': 0,
+    'configure_channel': 1, # channel
+    'trg_pre': 0,
+    'trg_suf': 0,
+    'trg_edge_level': 0,
+    'trg': 0,
+    'record_length': 0,
+    'channel_on': 1,
+    'voltage': 1,
+    'coupling': 1,
+    'timeout': 0,
+    'keepalive': 0,
+}
+
+# Per channel settings, they reach the device with a configure_channel
+CHANNEL_SETTINGS = ('channel_on','voltage','coupling')
+
+# Keeps only the latest value of every setting of a run of configuration
+# commands, at the place of the last command for it, so settings that
+# depend on each other (trigger lengths cut down by the record length) keep
+# their order. The settings of a channel and its configure_channel go as one:
+# the values set before its last configure_channel are sent with it, the ones
+# set after it stay after it.
+def coalesce(commands):
+    configured = {}
+    for (i,(cmd,args)) in enumerate(commands):
+        if cmd == 'configure_channel':
+            configured[args[0]] = i
+
+    # setting -> (position,command)
+    latest = {}
+    for (i,(cmd,args)) in enumerate(commands):
+        key = (cmd,) + tuple(args[:CONFIG_COMMANDS[cmd]])
+        position = i
+        if cmd in CHANNEL_SETTINGS and i < configured.get(args[0], -1):
+            key += ('configured',)
+            position = configured[args[0]] - 0.5
+        latest[key] = (position,(cmd,args))
+    return [ command for (position,command) in sorted(latest.values(), key=lambda item: item[0]) ]
+
+# Takes everything that is waiting in cmdQueue. Runs of configuration
+# commands are merged into one ('configure',commands) command, see
+# coalesce. Other commands are passed on as they are, in between.
+def takeCommands(cmdQueue):
+    commands = []
+    pending = []
+    while True:
+        try:
+            (cmd,args) = cmdQueue.get_nowait()
+        except Empty:
+            break
+
+        if cmd in CONFIG_COMMANDS:
+            pending.append((cmd,args))
+            continue
+
+        if pending:
+            commands.append(('configure',coalesce(pending)))
+            pending = []
+        commands.append((cmd,args))
+
+    if pending:
+        commands.append(('configure',coalesce(pending)))
+    return commands
+
+# Seconds between attempts to get a scope back that stopped answering
+RECOVERY_INTERVAL = 0.5
+
+# Put in the output queue instead of the reply of a command that failed,
+# the client raises it
+class ScopeError(Exception):
+    pass
+
+# Commands the client waits for a reply to
+REPLY_COMMANDS = set(['capture_start','get_data','capture_many','autoset','stats','sync','reconnect'])
+
+def needsReply(parent,cmd):
+    # A reconnect in continuous mode is not answered, see Scope.reconnect
+    return cmd in REPLY_COMMANDS and not (cmd == 'reconnect' and parent.continuous)
+
+# Sorts out what went wrong after a command failed. When the scope answers
+# and still has its bitstream it was the command itself, nothing is done.
+# Otherwise it restores the bitstream and settings when the scope still
+# answers, and reopens it when it went away. Commands that come in while it
+# keeps trying are kept for afterwards, except the ones a client waits on:
+# they are answered with a ScopeError right away. Returns
+# (close,deferred,lost): close is True when a close command came in while
+# waiting, lost when the scope had been reset or gone.
+def recover(parent,scope,cmdQueue,outQueue):
+    deferred = []
+    while True:
+        try:
+            try:
+                if scope.fpga_loaded():
+                    return (False,deferred,False)
+                lost = scope.restore()['uploaded']
+            except Exception as e:
+                print("The scope doesn't answer, reopening it:",e)
+                scope.reopen()
+                lost = True
+            print("Recovered the scope")
+            return (False,deferred,lost)
+        except Exception as e:
+            print("Unable to reopen the scope:",e)
+
+        deadline = time.time() + RECOVERY_INTERVAL
+        while time.time() < deadline:
+            time.sleep(0.01)
+            for (cmd,args) in takeCommands(cmdQueue):
+                if cmd == 'close':
+                    return (True,[],False)
+                elif needsReply(parent,cmd):
+                    outQueue.put(ScopeError("%s failed: the scope is not answering" % cmd))
+                elif cmd == 'stop_continuous':
+                    parent.continuous = False
+                    outQueue.put(Scope.STOPPED)
+                else:
+                    deferred.append((cmd,args))
 
 # Scope is the interface the application talks to.
 # The reason for this is that to ensure proper scope operation it must be continually polled (for some reason)
+# The captures are read with parent._read() and handed over with parent._package(),
+# so other backends can change how frames get to the client.
 def runThread(parent,cmdQueue,outQueue):
     scope = parent.scope
     close=False
+    initialised = False
+    # Commands that came in while recovering
+    deferred = []
+    # The command being run and the ones after it
+    pending = []
+    # VDS1022.roll() generator while rolling, see Scope.start_roll
+    roller = None
+    # Configuration commands that failed since the last sync, see Scope.sync
+    configErrors = []
+    rollInterval = None
     while not close:
         try:
-            scope.capture_init()
+            if not initialised:
+                scope.capture_init()
+                initialised = True
+            # Whether the continuous mode has a capture running
+            armed = False
+            lastKeepalive = time.time()
             while not close:
-                if not cmdQueue.empty():
-                    (cmd,args) = cmdQueue.get()
-                    if cmd == 'configure_timebase':
-                        scope.configure_timebase(args[0])
-                    elif cmd == 'configure_channel':
-                        scope.configure_channel(args[0])
-                    elif cmd == 'capture_init':
-                        scope.capture_init()
-                    elif cmd == 'capture_start':
-                        scope.capture_start()
-                        outQueue.put([ [],[] ])
-                    elif cmd ==  'get_data':
-                        print("waiting for data ready")
-                        timeout = time.time() + parent.timeout
-                        timedOut = False
-                        while scope.get_data_ready() == 0:
-                            if not timedOut and timeout < time.time():
-                                scope.force_trigger()
-                                timedOut = True
-                                #break
-                        if True: #not timedOut:
-                            print("Data ready")
-                            outQueue.put(scope.get_data())
-                        else:
-                            print("Timedout")
-                            scope.force_trigger()
-                    elif cmd == 'trg_pre':
-                        scope.configure_trg_pre(args[0])
-                    elif cmd == 'trg_suf':
-                        scope.configure_trg_suf(args[0])
-                    elif cmd == 'trg_edge_level':
-                        scope.configure_trg_edge_level(args[0])
-                    elif cmd == 'trg':
-                        scope.configure_trg(args[0],args[1],args[2])
-                    elif cmd == 'close':
-                        close=True
-                        break
-                    else:
-                        print("Received an unknown command",cmd)
-                        close=True
-                        break
+                if deferred or not cmdQueue.empty():
+                    commands = deferred + takeCommands(cmdQueue)
+                    deferred = []
+                    for (i,(cmd,args)) in enumerate(commands):
+                        pending = commands[i:]
+                        token = scope.stats.begin('command.' + cmd)
+                        try:
+                            if cmd == 'configure':
+                                # All register writes in one go. A bad
+                                # setting doesn't keep the others from being
+                                # applied, a failed batch is handled below.
+                                with scope.batch():
+                                    for (configCmd,configArgs) in args:
+                                        try:
+                                            applyConfig(parent,scope,configCmd,configArgs)
+                                        except Exception as e:
+                                            print("Unable to apply",configCmd,configArgs,e)
+                                            configErrors.append("%s %s: %s" % (configCmd, configArgs, e))
+                                # A running capture has the old settings
+                                armed = False
+                            elif cmd == 'capture_init':
+                                scope.capture_init()
+                                armed = False
+                            elif cmd == 'capture_start':
+                                scope.capture_start()
+                                outQueue.put([ [],[] ])
+                            elif cmd ==  'get_data':
+                                if scope.armed_at() is None:
+                                    # The capture was lost with the scope (or never started)
+                                    scope.capture_start()
+                                scope._log("waiting for data ready")
+                                (polls,forced) = scope.wait_for_capture(parent.timeout)
+                                if forced:
+                                    scope._log("Timedout, forced a trigger")
+                                scope._log("Data ready after %d polls" % polls)
+                                outQueue.put(parent._package(parent._read(scope)))
+                            elif cmd == 'capture_many':
+                                outQueue.put(scope.capture_many(args[0], args[1], timeout=parent.timeout))
+                            elif cmd == 'autoset':
+                                outQueue.put(autoset(scope, parent.timebaseValues, args[0]))
+                            elif cmd == 'stats':
+                                outQueue.put(parent._stats())
+                            elif cmd == 'reset_stats':
+                                scope.stats.reset()
+                                parent.reset_queue_stats()
+                            elif cmd == 'reconnect':
+                                result = scope.reopen()
+                                armed = False
+                                if not parent.continuous:
+                                    outQueue.put(result)
+                            elif cmd == 'sync':
+                                # Everything sent before this has been applied
+                                if configErrors:
+                                    outQueue.put(ScopeError("configuration failed: " + "; ".join(configErrors)))
+                                    configErrors = []
+                                else:
+                                    outQueue.put(Scope.SYNCED)
+                            elif cmd == 'start_continuous':
+                                parent.continuous = True
+                            elif cmd == 'start_roll':
+                                rollInterval = args[0]
+                                roller = scope.roll(interval=rollInterval)
+                                parent.continuous = True
+                            elif cmd == 'stop_continuous':
+                                parent.continuous = False
+                                armed = False
+                                if roller is not None:
+                                    # Turns slow-move off again
+                                    roller.close()
+                                    roller = None
+                                # Tells the client where the stream of frames ends
+                                outQueue.put(Scope.STOPPED)
+                            elif cmd == 'close':
+                                close=True
+                                break
+                            else:
+                                print("Received an unknown command",cmd)
+                                close=True
+                                break
+                        finally:
+                            scope.stats.end(token)
+                    pending = []
+
+                elif parent.continuous:
+                    # Commands that came in are applied between frames
+                    token = scope.stats.begin('continuous')
+                    try:
+                        if roller is not None:
+                            parent._deliver(parent._package_chunk(next(roller)))
+                            continue
+                        if not armed:
+                            scope.capture_start()
+                            armed = True
+                        scope.wait_for_capture(parent.timeout)
+                        frame = parent._read(scope)
+                        armed = False
+                        if not deferred and cmdQueue.empty():
+                            # Start the next one before converting this one.
+                            # Waiting commands go first, the next capture
+                            # has to be taken with their settings.
+                            scope.capture_start()
+                            armed = True
+                        parent._deliver(parent._package(frame))
+                    finally:
+                        scope.stats.end(token)
 
                 else:
                     # Wait 10ms so as not to use too much CPU time.
                     time.sleep(0.01)
-                    scope.checkBitstreamUpload()
+                    # Check the scope is still there every once in a while,
+                    # errors are handled below
+                    if parent.keepalive is not None and time.time() - lastKeepalive >= parent.keepalive:
+                        lastKeepalive = time.time()
+                        scope.keepalive()
 
         except Exception as e:
             print("Exception in thread",e)
             print(traceback.format_exc())
+            if pending and needsReply(parent,pending[0][0]):
+                # The client is waiting for this one, it isn't tried again
+                outQueue.put(ScopeError("%s failed: %s" % (pending[0][0], e)))
+                pending = pending[1:]
+                failed = None
+            else:
+                failed = pending[:1]
+                pending = pending[1:]
+            (close,deferred,lost) = recover(parent,scope,cmdQueue,outQueue)
+            if lost and failed:
+                # The scope was reset or gone, carry on where it stopped
+                pending = failed + pending
+            deferred = pending + deferred
+            pending = []
+            if not parent.continuous:
+                # Stopped while recovering
+                roller = None
+            if roller is not None:
+                # The exception ended the generator, roll on with a new one
+                roller = scope.roll(interval=rollInterval)
     scope.close()
 
 
 class Scope():
 
+    # Put in the output queue when the continuous mode stops
+    STOPPED = 'stopped'
+    # Reply to the sync command
+    SYNCED = 'synced'
+
+    # What the continuous mode does when the consumer can't keep up:
+    #  block        wait for room in the queue, the scope stops acquiring (lossless)
+    #  drop_oldest  throw away the oldest queued frame (live view)
+    #  latest       only keep the newest frame in the queue
+    BACKPRESSURE_POLICIES = [ 'block', 'drop_oldest', 'latest' ]
+    # How often a worker blocked on a full queue checks for close()
+    BLOCK_INTERVAL = 0.1
+
     # Timebase
     timebaseNames = ['100MSP', '50MSPS', '32MSPS', '16MSPS','8MSPS','4MSPS','2MSPS','1MSPS','500KSPS','250KSPS','125KSPS','62KSPS']
     timebaseValues = [     0x1,    0x02 ,     0x3 ,      0x6,   0x18,   0x30,   0x60,   0xc0,    0x180,    0x300,    0x600,  0xc00 ]
@@ -94,21 +365,42 @@ class Scope():
             trg_suf=5000,
             trg_pre=0,
             timeout=1,
+            verbose=True,
+            calibrationCache=None,
+            transport=None,
+            backpressure='block',
+            device=None,
+            journal=None,
+            keepalive=1.0,
+            recordLength=VDS1022.DEFAULT_RECORD_LENGTH,
             ):
 
 
         self.timeout = timeout
-        print("making a scope")
-        self.scope = VDS1022(voltage,coupling,channelOn,timebase,trg_suf,trg_pre)
-        print("made a scope")
-
-        self.cmdQueue = Queue(10)
-        self.outQueue = Queue(10)
-
-
-        print("in scope constructor timebase",timebase)
+        # Seconds between checks that the scope is still there while idle,
+        # None to never check
+        self.keepalive = keepalive
+        # Set while the worker captures without waiting for commands
+        self.continuous = False
+        # Set by close(), a worker waiting for room in the queue gives up
+        self.closing = False
+
+        self.set_backpressure(backpressure)
+        self.reset_queue_stats()
+        # Ring the worker reads its captures into
+        self._ring = FrameRing(2)
+        self.scope = VDS1022(voltage,coupling,channelOn,timebase,trg_suf,trg_pre,verbose,calibrationCache,transport,device,journal,recordLength=recordLength)
+        self.scope._log("made a scope")
+
+        # The worker merges configuration commands, so the GUI never has to
+        # wait for room here
+        self.cmdQueue = Queue()
+        self.outQueue = self._new_out_queue()
+
+
+        self.scope._log("in scope constructor timebase",timebase)
         try:
-            print("Trying to make new thread")
+            self.scope._log("Trying to make new thread")
             self.thread = Thread(target=runThread,args=(self,self.cmdQueue,self.outQueue))
             self.thread.start()
             self.configure_timebase(timebase)
@@ -116,6 +408,24 @@ class Scope():
         except Exception as e:
             print("Unable to start thread",e)
 
+    def _new_out_queue(self):
+        return Queue(10)
+
+    # The worker's reply to the command just sent, raises when it failed
+    def _reply(self):
+        item = self.outQueue.get()
+        if isinstance(item,ScopeError):
+            raise item
+        return item
+
+    # Waits until the worker has applied all the commands sent before. Raises
+    # a ScopeError when any of the settings couldn't be applied.
+    def sync(self):
+        if self.continuous:
+            raise Exception("sync is not available in continuous mode")
+        self.cmdQueue.put(['sync',[]])
+        self._reply()
+
     def configure_timebase(self,speed):
         self.cmdQueue.put(['configure_timebase',[speed]])
 
@@ -123,6 +433,7 @@ class Scope():
         self.cmdQueue.put(['configure_channel',[channel]])
 
     def close(self):
+        self.closing = True
         self.cmdQueue.put(['close',[]])
 
     def capture_init(self):
@@ -132,13 +443,172 @@ class Scope():
         return self.capture_start()
 
     def capture_start(self):
+        if self.continuous:
+            # The worker keeps the scope armed itself
+            return [ [],[] ]
         self.cmdQueue.put(['capture_start',[]])
-        return self.outQueue.get()
+        return self._reply()
 
     def get_data(self):
+        if self.continuous:
+            return self.read_frame()[1]
+
         self.cmdQueue.put(['get_data',[]])
 
-        return self.outQueue.get()
+        return self._unpack(self._reply())[1]
+
+    # n captures back to back, see VDS1022.capture_many. Returns (data,timing)
+    # with data shaped (n, enabled channels, samples).
+    def capture_many(self,n,dtype='int8'):
+        if self.continuous:
+            raise Exception("capture_many is not available in continuous mode")
+        self.cmdQueue.put(['capture_many',[n,dtype]])
+        return self._reply()
+
+    # Picks voltage, timebase and trigger of channel from a few captures and
+    # leaves the scope set up with them, see autoset.py. Returns what was
+    # picked and the number of captures it took.
+    def autoset(self,channel=0):
+        if self.continuous:
+            raise Exception("autoset is not available in continuous mode")
+        self.cmdQueue.put(['autoset',[channel]])
+        return self._reply()
+
+    # Continuous mode:
+    # The worker thread arms, waits and reads captures back to back and puts
+    # them in the output queue as (timestamp,data) tuples, read them with
+    # read_frame(). Configuration calls still work, they are applied between
+    # two captures.
+    def start_continuous(self):
+        self.continuous = True
+        self.cmdQueue.put(['start_continuous',[]])
+
+    # Roll mode, for slow timebases (see VDS1022.roll): like the continuous
+    # mode, but read_frame() returns (timestamp,chunk) with the samples
+    # acquired since the previous chunk. Stop it with stop_continuous().
+    def start_roll(self,interval=None):
+        self.continuous = True
+        self.cmdQueue.put(['start_roll',[interval]])
+
+    def stop_continuous(self):
+        if not self.continuous:
+            return
+        self.cmdQueue.put(['stop_continuous',[]])
+        # Throw away the frames that were still on their way
+        while True:
+            item = self.outQueue.get()
+            if isinstance(item,str) and item == self.STOPPED:
+                break
+            if not isinstance(item,ScopeError):
+                self._discard(item)
+        self.continuous = False
+
+    def set_backpressure(self,policy):
+        if policy not in self.BACKPRESSURE_POLICIES:
+            raise Exception("unknown backpressure policy %s" % policy)
+        self.backpressure = policy
+
+    def reset_queue_stats(self):
+        self.framesDelivered = 0
+        self.framesDropped = 0
+        self.queueHighWater = 0
+
+    def queue_stats(self):
+        return {
+                'policy': self.backpressure,
+                'delivered': self.framesDelivered,
+                'dropped': self.framesDropped,
+                'highWater': self.queueHighWater,
+                'queued': self.outQueue.qsize(),
+                'capacity': self._queue_capacity(),
+            }
+
+    def _queue_capacity(self):
+        return self.outQueue.maxsize
+
+    # Timing and USB traffic per operation (see stats.py) together with the
+    # queue statistics, as a JSON serializable dict
+    def stats(self):
+        return self._stats()
+
+    def save_stats(self,path):
+        with open(path,'w') as f:
+            json.dump(self.stats(), f, indent=2)
+
+    def reset_stats(self):
+        self.scope.stats.reset()
+        self.reset_queue_stats()
+
+    def _stats(self):
+        ret = self.scope.stats.snapshot()
+        ret['queue'] = self.queue_stats()
+        ret['skippedWrites'] = self.scope.skippedWrites
+        return ret
+
+    # Worker side: read the data of a finished capture
+    def _read(self,scope):
+        if self._ring.length < scope.packet_length():
+            # The record length went up
+            self._ring = FrameRing(2, length=scope.packet_length())
+        return scope.read_frame(self._ring)
+
+    # Worker side: what goes into the output queue for a capture
+    def _package(self,frame):
+        return (frame.timestamp, frame.data())
+
+    # Worker side: what goes into the output queue for a roll mode chunk
+    def _package_chunk(self,chunk):
+        return chunk
+
+    # Client side: turns what _package made into (timestamp,data)
+    def _unpack(self,item):
+        return item
+
+    # Client side: a frame is thrown away without being unpacked
+    def _discard(self,item):
+        pass
+
+    # Called by the worker to hand a continuous mode frame to the client
+    def _deliver(self,frame):
+        # Time spent waiting for the client shows up here
+        token = self.scope.stats.begin('deliver')
+        try:
+            if self.backpressure == 'latest':
+                self._drop(self.outQueue.qsize())
+            while not self.closing:
+                try:
+                    if self.backpressure == 'block':
+                        self.outQueue.put(frame, timeout=self.BLOCK_INTERVAL)
+                    else:
+                        self.outQueue.put_nowait(frame)
+                    break
+                except Full:
+                    if self.backpressure != 'block':
+                        self._drop(1)
+            else:
+                # Nobody is going to take it
+                self._discard(frame)
+                return
+        finally:
+            self.scope.stats.end(token)
+
+        self.framesDelivered += 1
+        self.queueHighWater = max(self.queueHighWater, self.outQueue.qsize())
+
+    def _drop(self,count):
+        for i in range(count):
+            try:
+                self._discard(self.outQueue.get_nowait())
+                self.framesDropped += 1
+            except Empty:
+                break
+
+    # The next (timestamp,data) of the continuous mode, None on timeout
+    def read_frame(self,timeout=None):
+        try:
+            return self._unpack(self.outQueue.get(timeout=timeout))
+        except Empty:
+            return None
       
     def channel_on(self,channelIdx,on):
         self.scope.channelOn[channelIdx] = on
@@ -148,7 +618,18 @@ class Scope():
 
     def setCoupling(self,channelIdx,coupling):
         self.scope.coupling[channelIdx] = coupling
+
+    def get_range(self,channelIdx):
+        return self.scope.get_range(channelIdx)
    
+    # Samples the scope records per channel, see VDS1022.configure_record_length
+    def configure_record_length(self,length):
+        self.cmdQueue.put(['record_length',[length]])
+
+    # Samples per channel of the captures, once the worker applied the record length
+    def samples_per_channel(self):
+        return self.scope.samples_per_channel()
+
     def configure_trg_suf(self,val):
         self.cmdQueue.put(['trg_suf',[val]])
 
@@ -161,6 +642,17 @@ class Scope():
     def configure_trg(self,triggerType,triggerChannel,triggerExtra):
         self.cmdQueue.put(['trg',[triggerType,triggerChannel, triggerExtra]])
 
+    # Changes how often the idle worker checks on the scope, see keepalive
+    def set_keepalive(self,interval):
+        self.cmdQueue.put(['keepalive',[interval]])
+
+    # Reopens the scope in place, for when it dropped off the bus: the
+    # bitstream is only uploaded when the FPGA lost it and the last settings
+    # are written back as one batch. Returns what VDS1022.reopen returns, in
+    # continuous mode it doesn't wait and the frames resume afterwards.
     def reconnect(self):
-        pass
+        self.cmdQueue.put(['reconnect',[]])
+        if self.continuous:
+            return None
+        return self._reply()
 
@@ -0,0 +1,148 @@
+import time,json
+from functools import wraps
+
+# Where the time of a capture cycle goes.
+#
+# Every VDS1022 has a Stats object (vds.stats) that keeps, per operation:
+# how often it ran, how long it took (total, min, max and a histogram) and
+# the USB transactions and bytes it caused. Operations nest: their time
+# includes the nested ones, a transfer is counted once, in the innermost
+# running operation, and as 'inclusive' in every running one. Recording
+# costs two perf_counter calls and a few additions, set enabled to False to
+# skip even that.
+#
+#   vds.stats.reset()
+#   ...
+#   print(vds.stats.to_json())
+
+# Histogram bucket i counts durations below 2**i microseconds (and at least
+# half that), the last bucket takes everything longer.
+HISTOGRAM_BUCKETS = 24
+
+class OperationStats:
+    __slots__ = ['count','total','min','max','histogram','writes','reads','bytesWritten','bytesRead','inclusive']
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+        self.writes = 0
+        self.reads = 0
+        self.bytesWritten = 0
+        self.bytesRead = 0
+        # The same, with the transfers of the nested operations
+        self.inclusive = {'writes': 0, 'reads': 0, 'bytesWritten': 0, 'bytesRead': 0}
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        if self.min is None or elapsed < self.min:
+            self.min = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        bucket = min(int(elapsed * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.histogram[bucket] += 1
+
+    def as_dict(self):
+        return {
+                'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else 0.0,
+                'min': self.min if self.min is not None else 0.0,
+                'max': self.max,
+                # Upper bound in microseconds -> count, empty buckets left out
+                'histogram': { (1 << i): n for (i,n) in enumerate(self.histogram) if n },
+                'writes': self.writes,
+                'reads': self.reads,
+                'bytesWritten': self.bytesWritten,
+                'bytesRead': self.bytesRead,
+                'inclusive': dict(self.inclusive),
+            }
+
+
+class Stats:
+    # Transfers done outside of any timed operation
+    UNTIMED = 'untimed'
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.operations = {}
+        self.since = time.time()
+        # Names of the running operations, innermost last
+        self._running = []
+
+    def _operation(self, name):
+        stats = self.operations.get(name)
+        if stats is None:
+            stats = self.operations[name] = OperationStats()
+        return stats
+
+    # Start timing name, pass what this returns to end()
+    def begin(self, name):
+        if not self.enabled:
+            return None
+        self._running.append(name)
+        return (name, time.perf_counter())
+
+    def end(self, token):
+        if token is None:
+            return
+        (name, start) = token
+        elapsed = time.perf_counter() - start
+        # An exception can leave inner operations on the stack
+        while self._running and self._running.pop() != name:
+            pass
+        self._operation(name).add(elapsed)
+
+    # Records a USB transfer of length bytes, direction 'w' or 'r'
+    def transfer(self, direction, length):
+        if not self.enabled:
+            return
+        running = self._running or [self.UNTIMED]
+        stats = self._operation(running[-1])
+        if direction == 'w':
+            stats.writes += 1
+            stats.bytesWritten += length
+        else:
+            stats.reads += 1
+            stats.bytesRead += length
+        # An operation nested in itself still counts it once
+        for name in set(running):
+            inclusive = self._operation(name).inclusive
+            if direction == 'w':
+                inclusive['writes'] += 1
+                inclusive['bytesWritten'] += length
+            else:
+                inclusive['reads'] += 1
+                inclusive['bytesRead'] += length
+
+    def snapshot(self):
+        # The worker thread could be adding operations
+        operations = list(self.operations.items())
+        return {
+                'since': self.since,
+                'duration': time.time() - self.since,
+                'operations': { name: stats.as_dict() for (name,stats) in operations },
+            }
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.snapshot(), **kwargs)
+
+
+# Times the decorated method as operation name in self.stats
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self,*args,**kwargs):
+            token = self.stats.begin(name)
+            try:
+                return func(self,*args,**kwargs)
+            finally:
+                self.stats.end(token)
+        return wrapper
+    return decorator
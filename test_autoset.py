@@ -0,0 +1,66 @@
+import numpy as np
+from vds1022 import VDS1022
+from scope import Scope
+from autoset import Autoset
+from emulator import EmulatedVDS1022, sine
+
+EDGE_LEVEL_CH1 = 46
+
+# Keeps the voltage of every capture
+class RecordingAutoset(Autoset):
+    def __init__(self, *args, **kwargs):
+        Autoset.__init__(self, *args, **kwargs)
+        self.voltages = []
+
+    def capture(self):
+        self.voltages.append(self.vds.voltage[self.channel])
+        return Autoset.capture(self)
+
+def run_autoset(amplitude, frequency=1e3):
+    device = EmulatedVDS1022(
+            waveforms=[ sine(amplitude, frequency), sine(0, frequency) ],
+            units='volts',
+            timeScale=0,
+            bitstreamLoaded=True,
+        )
+    vds = VDS1022(verbose=False, transport=device)
+    try:
+        vds.capture_init()
+        autoset = RecordingAutoset(vds, Scope.timebaseValues)
+        result = autoset.run()
+        result['edgeLevel'] = device._register(EDGE_LEVEL_CH1, 2)
+        return (result, autoset.voltages)
+    finally:
+        vds.close()
+
+def test_prediction_is_checked_once():
+    for amplitude in (1.0, 3.0):
+        (result, voltages) = run_autoset(amplitude)
+        fit = Autoset.fitting_voltage(amplitude)
+        assert result['voltage'] == fit
+        # The top voltage predicts the fit, one capture confirms it
+        assert voltages[:2] == [len(VDS1022.vdivs) - 1, fit]
+        assert not result['clipped']
+        assert abs(result['frequency'] - 1e3) < 10
+        assert result['captures'] <= 4
+
+def test_too_big_for_the_largest_voltage():
+    (result, voltages) = run_autoset(60.0)
+    assert result['voltage'] == len(VDS1022.vdivs) - 1
+    assert result['clipped']
+
+def test_edge_level_layout():
+    # What capture_init writes
+    assert VDS1022.edge_level(45, 5) == 0x2832
+    assert VDS1022.edge_level(-1, 2) == 0xfd01
+    assert VDS1022.edge_level(126, 4) == 0x7a7f
+
+def test_trigger_at_the_middle():
+    (result, voltages) = run_autoset(1.0)
+    level = result['level']
+    # A sine around 0V
+    assert abs(result['levelVolts']) < 0.1
+    edge = result['edgeLevel']
+    (upper, lower) = [ int(v) for v in np.array([ edge & 0xff, edge >> 8 ], dtype=np.uint8).view(np.int8) ]
+    assert lower < level < upper
+    assert upper + lower == 2 * level
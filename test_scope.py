@@ -0,0 +1,106 @@
+import time
+import pytest
+import numpy as np
+from queue import Queue
+from scope import Scope, ScopeError, takeCommands
+from emulator import EmulatedVDS1022, sine
+
+# The emulator scales this 1V sine with the channel voltage the capture was
+# started with, so a frame converted with another voltage is off by 2x or more
+AMPLITUDE = 1.0
+
+def make_scope(voltage):
+    device = EmulatedVDS1022(
+            waveforms=[ sine(AMPLITUDE, 1e3), sine(0, 1e3) ],
+            units='volts',
+            timeScale=0,
+            bitstreamLoaded=True,
+        )
+    return Scope(voltage=[voltage,voltage], timebase=0x60, timeout=0.1, verbose=False, transport=device)
+
+def check_frame(scope):
+    frame = scope.read_frame(5)
+    assert frame is not None
+    (timestamp, data) = frame
+    peak = float(np.abs(data[0]).max())
+    assert abs(peak - AMPLITUDE) < 0.1 * AMPLITUDE, "frame peak %.3fV" % peak
+
+def test_voltage_change_mid_stream():
+    scope = make_scope(6)
+    try:
+        scope.start_continuous()
+        for voltage in (7, 6, 8, 6, 7):
+            for i in range(3):
+                check_frame(scope)
+            scope.setVoltage(0, voltage)
+            scope.configure_channel(0)
+        for i in range(5):
+            check_frame(scope)
+        scope.stop_continuous()
+    finally:
+        scope.close()
+
+def test_close_with_full_queue():
+    scope = make_scope(6)
+    scope.start_continuous()
+    # Nobody reads, the worker fills the queue and blocks on it
+    while scope.outQueue.qsize() < scope._queue_capacity():
+        time.sleep(0.01)
+    scope.close()
+    scope.thread.join(5)
+    assert not scope.thread.is_alive()
+
+def test_take_commands_keeps_order():
+    queue = Queue()
+    for command in [ ['voltage',[0,3]], ['configure_channel',[0]], ['voltage',[0,5]],
+            ['configure_timebase',[0x30]], ['configure_timebase',[0x60]], ['sync',[]] ]:
+        queue.put(command)
+    assert takeCommands(queue) == [
+            ('configure', [ ('voltage',[0,3]), ('configure_channel',[0]), ('voltage',[0,5]),
+                ('configure_timebase',[0x60]) ]),
+            ('sync',[]),
+        ]
+
+def test_gui_refreshes_are_coalesced():
+    queue = Queue()
+    for (timebase, voltage) in [ (0x30, 5), (0x60, 6), (0x90, 7) ]:
+        for command in [ ['configure_timebase',[timebase]], ['trg_pre',[10]], ['trg_suf',[4000]],
+                ['voltage',[0,voltage]], ['configure_channel',[0]],
+                ['voltage',[1,voltage]], ['configure_channel',[1]],
+                ['trg',[0,0,0]], ['trg_edge_level',[0x2832]] ]:
+            queue.put(command)
+    assert takeCommands(queue) == [
+            ('configure', [ ('configure_timebase',[0x90]), ('trg_pre',[10]), ('trg_suf',[4000]),
+                ('voltage',[0,7]), ('configure_channel',[0]),
+                ('voltage',[1,7]), ('configure_channel',[1]),
+                ('trg',[0,0,0]), ('trg_edge_level',[0x2832]) ]),
+        ]
+
+def test_bad_setting_does_not_drop_the_others():
+    scope = make_scope(7)
+    try:
+        scope.setVoltage(0, 6)
+        scope.configure_channel(0)
+        scope.configure_record_length(50)
+        with pytest.raises(ScopeError):
+            scope.sync()
+        assert scope.scope.configuredVoltage[0] == 6
+        # The emulator scales the sine with the voltage the device has
+        scope.capture_start()
+        data = scope.get_data()
+        peak = float(np.abs(data[0]).max())
+        assert abs(peak - AMPLITUDE) < 0.1 * AMPLITUDE, "peak %.3fV" % peak
+    finally:
+        scope.close()
+
+def test_failed_command_raises_in_client():
+    scope = make_scope(6)
+    try:
+        with pytest.raises(ScopeError):
+            scope.capture_many(1, dtype='no such type')
+        # The scope was fine, it keeps working without a restore
+        (data, timing) = scope.capture_many(1, dtype='float32')
+        assert data.shape[0] == 1
+        assert scope.scope.recoveries == 0
+    finally:
+        scope.close()
@@ -0,0 +1,27 @@
+import numpy as np
+from vds1022 import UsbTransport
+
+# Stands in for a usb1 device handle, bulkRead takes a length like libusb does
+class FakeHandle:
+    def __init__(self, data):
+        self.data = data
+        self.calls = []
+
+    def bulkRead(self, endpoint, length, timeout):
+        assert isinstance(length, int)
+        self.calls.append((endpoint, length, timeout))
+        return bytearray(self.data[:length])
+
+def make_transport(data):
+    # Without _connect, that needs a device
+    transport = UsbTransport.__new__(UsbTransport)
+    transport.readEndpoint = 0x81
+    transport.handle = FakeHandle(data)
+    return transport
+
+def test_read_into_passes_a_length():
+    transport = make_transport(bytes([1, 2, 0xff, 4]))
+    dest = np.zeros(10, dtype=np.int8)
+    assert transport.read_into(dest) == 4
+    assert transport.handle.calls == [ (0x81, 10, UsbTransport.TIMEOUT) ]
+    assert list(dest[:5]) == [1, 2, -1, 4, 0]
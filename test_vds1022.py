@@ -0,0 +1,64 @@
+import struct
+import numpy as np
+import threading
+from vds1022 import VDS1022
+from emulator import EmulatedVDS1022, sine
+
+TRG_ADDRESS = 36
+
+# Keeps the values written to the trigger register
+class RecordingEmulator(EmulatedVDS1022):
+    def __init__(self, *args, **kwargs):
+        EmulatedVDS1022.__init__(self, *args, **kwargs)
+        self.triggers = []
+
+    def write(self, buf):
+        (address, length) = struct.unpack('<IB', bytes(buf[:5]))
+        if address == TRG_ADDRESS and length == 2:
+            self.triggers.append(struct.unpack('<H', bytes(buf[5:7]))[0])
+        return EmulatedVDS1022.write(self, buf)
+
+def make_vds(device=None):
+    if device is None:
+        device = EmulatedVDS1022(timeScale=0, bitstreamLoaded=True)
+    return VDS1022(verbose=False, transport=device)
+
+def test_scopes_on_threads_send_their_own_packets():
+    devices = [ RecordingEmulator(timeScale=0, bitstreamLoaded=True) for i in range(2) ]
+    scopes = [ make_vds(device) for device in devices ]
+    assert scopes[0]._encoder(TRG_ADDRESS, 2) is not scopes[1]._encoder(TRG_ADDRESS, 2)
+
+    def write(scope, base):
+        for i in range(2000):
+            scope.write_register('TRG_ADD', base + i % 2)
+
+    threads = [ threading.Thread(target=write, args=(scope, 0x1000 * (i + 1)))
+            for (i,scope) in enumerate(scopes) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for (i,device) in enumerate(devices):
+        base = 0x1000 * (i + 1)
+        assert len(device.triggers) >= 2000
+        assert set(device.triggers[-2000:]) == set([base, base + 1])
+
+def capture_segments(chunk, n, dtype):
+    device = EmulatedVDS1022(waveforms=[ sine(1.0, 1e3), sine(0.5, 3e3) ], units='volts',
+            timeScale=0, bitstreamLoaded=True)
+    vds = VDS1022(verbose=False, transport=device, channelOn=[True,True], voltage=[6,6])
+    vds.CAPTURE_MANY_CHUNK = chunk
+    try:
+        vds.capture_init()
+        return vds.capture_many(n, dtype=dtype)
+    finally:
+        vds.close()
+
+def test_capture_many_in_chunks():
+    for dtype in ('int8', 'float32'):
+        (whole, timing) = capture_segments(64, 7, dtype)
+        (chunked, chunkedTiming) = capture_segments(3, 7, dtype)
+        assert chunked.shape == (7, 2, whole.shape[2])
+        assert np.array_equal(chunked, whole)
+        assert np.all(np.diff(chunkedTiming[:,0]) >= 0)
+        assert np.all(chunkedTiming[:,1] >= chunkedTiming[:,0])
@@ -1,22 +1,32 @@
-import usb1,struct,traceback,sys,math
+import usb1,struct,traceback,sys,math,time,json,os
+from contextlib import contextmanager
+from functools import wraps
+from collections import deque
 import numpy as np
+from commands import REGISTERS, PacketEncoder
+from stats import Stats, timed
+import journal
 
 def AddValueAttachCommand(name,address,length,value):
-    ret = struct.pack("<IB",address,length) 
-    for i in range(length):
-        ret += bytes([value & 0xFF])
-        value>>=8 
-    return ret
+    return PacketEncoder(address,length).pack(value)
+
+# Sends all the register writes done by the decorated method as one batch
+def batched(func):
+    @wraps(func)
+    def wrapper(self,*args,**kwargs):
+        with self.batch():
+            return func(self,*args,**kwargs)
+    return wrapper
 
 def printBytes(val):
-    for i in range(len(val)):
-        if i % 16 == 0:
-            print('')
-        print("%2.2x"%val[i],end=' ')
-    print('')
+    val = bytes(val)
+    lines = [ ' '.join("%2.2x" % b for b in val[i:i+16]) for i in range(0,len(val),16) ]
+    print('\n' + '\n'.join(lines))
 
 class VDS1022:
     debug = False
+    # Set to False to silence the progress messages
+    verbose = True
     # Some Device specific USB parameters
     VENDOR_ID =  0x5345
     PRODUCT_ID = 0x1234
@@ -25,6 +35,25 @@ class VDS1022:
     BULK_READ_ENDPOINT = 0x81
     DEFAULT_RESPONSE_LENGTH = 5
 
+    # Data packets: an 11 byte header followed by the samples of one channel:
+    # a 100 byte trigger buffer and the record (record_length samples)
+    FRAME_HEADER_LENGTH = 11
+    TRIGGER_BUFFER_LENGTH = 100
+    # Record lengths, the dm register. The default is what the Owon software
+    # uses and the most the acquisition memory of the VDS1022 (5k samples
+    # per channel) is known to hold. The 16 bit register takes more, but
+    # nothing shows the hardware stores longer records.
+    DEFAULT_RECORD_LENGTH = 0x13ec
+    MIN_RECORD_LENGTH = 200
+    MAX_RECORD_LENGTH = DEFAULT_RECORD_LENGTH
+    # Packet length for the default and the longest record
+    FRAME_PACKET_LENGTH = FRAME_HEADER_LENGTH + TRIGGER_BUFFER_LENGTH + DEFAULT_RECORD_LENGTH
+    MAX_PACKET_LENGTH = FRAME_HEADER_LENGTH + TRIGGER_BUFFER_LENGTH + MAX_RECORD_LENGTH
+    # Bulk transfers end with a packet shorter than this
+    USB_PACKET_SIZE = 512
+    # Header, trigger buffer and the first (often bad) sample are skipped
+    FRAME_DATA_OFFSET = 11 + 100 + 1
+
     #calibration types
     GAIN = 0
     AMPLITUDE = 1
@@ -32,6 +61,24 @@ class VDS1022:
 
     ZEROOFF_HACK = 0
 
+    # The timebase register divides this clock to get the sample rate
+    SAMPLE_CLOCK = 100e6
+
+    # Slowest sample rates (timebase register values) roll() accepts. At
+    # faster rates the record fills quicker than we can poll it.
+    SLOWMOVE_MIN_TIMEBASE = 0x600
+    # How often roll() reads the record being filled, and the fewest new
+    # samples a read has to bring (a read transfers the whole record)
+    ROLL_INTERVAL = 0.02
+    ROLL_MIN_SAMPLES = 64
+
+    # Polling intervals used by wait_for_capture once the estimate has passed
+    MIN_POLL_INTERVAL = 0.0005
+    MAX_POLL_INTERVAL = 0.05
+
+    # Registers whose last written value we remember, see _packed_cmd_response
+    SHADOWED_ADDRESSES = REGISTERS.setting_addresses()
+
     vdivs = [
 	[ 5, 1000 ],
 	[ 10, 1000 ],
@@ -56,86 +103,323 @@ class VDS1022:
             channelOn=[True,False],
             timebase = 0x190,
             trg_suf=5000,
-            trg_pre=0
+            trg_pre=0,
+            verbose=True,
+            calibrationCache=None,
+            transport=None,
+            device=None,
+            journal=None,
+            recordLength=DEFAULT_RECORD_LENGTH,
         ):
         # Save the parameters
-        self.voltage = voltage 
-        self.coupling = coupling
-        self.channelOn = channelOn
+        self.verbose = verbose
+        # Which scope to open when there are several, see UsbTransport
+        self.device = device
+        # Path of the on-disk calibration cache, True for the default one
+        if calibrationCache is True:
+            calibrationCache = self.DEFAULT_CALIBRATION_CACHE
+        self.calibrationCache = calibrationCache
+        # Copies, the defaults would otherwise be shared between scopes
+        self.voltage = list(voltage)
+        # The voltages configure_channel last wrote to the device, what the
+        # captures are taken and converted with. voltage can be changed
+        # ahead of that while a capture is running.
+        self.configuredVoltage = list(voltage)
+        self.coupling = list(coupling)
+        self.channelOn = list(channelOn)
         self.timebase = timebase
         self.trg_pre = trg_pre
         self.trg_suf = trg_suf
+        self.record_length = recordLength
+        # Set while roll() streams, configure_timebase turns slow-move on
+        self.slowmove = False
 
         self.calibration_data = [[[0 for k in range(10)] for j in range(2)] for i in range(3)]
 
-        print("trying to open usb")
-        self._openUsb()
+        # Packets queued by begin_batch(), None when not batching
+        self._batch = None
 
-        try:
-            #Check machine code
-            print("Trying to check the machine type")
-            version =  self._packed_cmd_response( 0x4001, 86, 1, 'V') # MACHINE_TYPE_ADD
-            if version != 1:
-                print ("this does not appear to be a VDS")
-                raise Exception("This does not appear to be a VDS1022")
+        # Conversion tables, see lut()
+        self._luts = {}
 
-            print("This appears to be a VDS1022")
+        # Called once the writes queued before them went out, see _after_writes
+        self._afterBatch = []
+        # Packet encoders by (address,length), see _encoder
+        self._encoders = {}
+        # Shadow copy of the device registers: address -> (length,value)
+        self._shadow = {}
+        # Every setting written so far, in the same form. Unlike the shadow
+        # this survives losing the device, see replay_configuration
+        self._config = {}
+        self.recoveries = 0
+        self.skippedWrites = 0
 
-            self.checkBitstreamUpload()
+        # Statistics of the last bitstream upload, see _uploadBitstream
+        self.lastUploadStats = None
 
-            # read the calibration data
-            self.write(AddValueAttachCommand("read_flash", 432, 1, 1))
-            calibration_data = self.read(2002)
+        # When the last capture was started, used to time wait_for_capture
+        self._armedAt = None
 
-            if self.debug:
-                printBytes(calibration_data)
-            
-            self._parse_flash(calibration_data)
+        # Set while frames() has asynchronous reads running
+        self._asyncReader = None
+
+        # Binary record of the USB traffic, see start_journal
+        self.journal = None
+        self._ownJournal = False
+        if journal is not None:
+            self.start_journal(journal)
+
+        # Timing and USB traffic per operation, see stats.py
+        self.stats = Stats()
+
+        # Moves the bytes to and from the device, see UsbTransport
+        self.transport = transport
+        if self.transport is None:
+            self._log("trying to open usb")
+            self._openUsb()
+
+        try:
+            self._check_machine_type()
+
+            self.checkBitstreamUpload()
+
+            if not self._load_calibration():
+                self.read_calibration()
+                self._save_calibration()
         except Exception as e:
             traceback.print_exc()
             print(e)
-            self.handle.close()
+            self.close()
+
+    def _check_machine_type(self):
+        #Check machine code
+        self._log("Trying to check the machine type")
+        version =  self.write_register('MACHINE_TYPE_ADD', 86, expectedResponse='V')
+        if version != 1:
+            print ("this does not appear to be a VDS")
+            raise Exception("This does not appear to be a VDS1022")
+
+        self._log("This appears to be a VDS1022")
+
+    def _log(self,*args,**kwargs):
+        if self.verbose:
+            print(*args,**kwargs)
+
+    def read_calibration(self):
+        self._send_register('read_flash', 1)
+        calibration_data = self.read(2002)
+
+        if self.debug:
+            printBytes(calibration_data)
+
+        self._parse_flash(calibration_data)
+
+    # Calibration cache:
+    # The calibration data is stored in the flash of the scope and never
+    # changes, so it can be kept on disk keyed by the serial number of the
+    # device to save reading and parsing the flash at every start.
+    DEFAULT_CALIBRATION_CACHE = os.path.join(os.path.expanduser('~'),'.cache','pyVds1022','calibration.json')
+    CALIBRATION_CACHE_VERSION = 1
+
+    # Something that identifies this particular scope: the serial number if
+    # it has one, otherwise where it is plugged in.
+    def device_identity(self):
+        return self.transport.identity()
+
+    # The calibration cache key: only the serial number, a scope without one
+    # can't be told apart from another one plugged into the same port.
+    def _calibration_key(self):
+        identity = self.device_identity()
+        if identity.startswith('serial:'):
+            return identity
+        return None
+
+    def _read_calibration_cache(self):
+        try:
+            with open(self.calibrationCache) as cacheFile:
+                cache = json.load(cacheFile)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(cache,dict) or cache.get('version') != self.CALIBRATION_CACHE_VERSION:
+            return {}
+        return cache
+
+    def _load_calibration(self):
+        if not self.calibrationCache:
+            return False
+        key = self._calibration_key()
+        if key is None:
+            self._log("No serial number, not using the calibration cache")
+            return False
+
+        entry = self._read_calibration_cache().get('devices',{}).get(key)
+        if entry is None:
+            return False
+
+        calibration = np.array(entry.get('calibration',[]))
+        if entry.get('flashVersion') != 2 or calibration.shape != (3,2,10):
+            return False
+
+        self.calibration_data = (calibration & 0xffFF).tolist()
+        self.invalidate_luts()
+        self._log("Using cached calibration for",key)
+        return True
+
+    def _save_calibration(self):
+        key = self._calibration_key()
+        if not self.calibrationCache or key is None:
+            return
+
+        cache = self._read_calibration_cache()
+        cache['version'] = self.CALIBRATION_CACHE_VERSION
+        cache.setdefault('devices',{})[key] = {
+                'flashVersion': 2,
+                'calibration': self.calibration_data,
+            }
+        try:
+            directory = os.path.dirname(self.calibrationCache)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # Write and rename, so a crash can't leave half a file behind
+            tmpPath = self.calibrationCache + '.tmp'
+            with open(tmpPath,'w') as cacheFile:
+                json.dump(cache,cacheFile)
+            os.replace(tmpPath,self.calibrationCache)
+        except OSError as e:
+            self._log("Unable to save the calibration cache:",e)
+
+    # Whether the FPGA has its bitstream, it loses it when the scope resets.
+    # A single round trip, this is also the keepalive query.
+    def fpga_loaded(self):
+        return self.write_register('FPGA_DOWNLOAD_QUERY_ADD', 0, expectedResponse='E') != 0
 
     def checkBitstreamUpload(self):
         # Check if we need to upload the FPGA bitstream
-        response = self._packed_cmd_response( 547, 0, 1, 'E') # FPGA_DOWNLOAD_QUERY_ADD
-        
-        if response == 0:
-            print("uploading bitstream")
-            self._uploadBitstream()
-            print("done")
+        if not self.fpga_loaded():
+            self._log("uploading bitstream")
+            stats = self._uploadBitstream()
+            self._log("done, %d bytes in %.2fs (%.0f kB/s)" % (stats['bytes'], stats['duration'], stats['throughput'] / 1000))
+            return stats
+        return None
+
+    # Watchdog: checks the device still has its bitstream, and restores it
+    # when it was reset. Returns True when it had to be restored. Raises
+    # when the device doesn't answer, reopen() gets it back then.
+    def keepalive(self):
+        if self.fpga_loaded():
+            return False
+        self._log("The scope was reset, restoring it")
+        self.restore()
+        return True
+
+    # Brings the device back to the configuration written last: uploads the
+    # bitstream if it is missing and replays the settings. Returns what it
+    # did: whether the bitstream was uploaded and the number of registers.
+    def restore(self):
+        upload = self.checkBitstreamUpload()
+        if upload is not None:
+            # A capture that was running is gone with the old bitstream
+            self._armedAt = None
+        registers = self.replay_configuration()
+        self.recoveries += 1
+        return {'uploaded': upload is not None, 'registers': registers}
+
+    # Writes every setting written so far again, as one batch
+    def replay_configuration(self):
+        self.invalidate_shadow()
+        with self.batch():
+            for (address,(length,value)) in list(self._config.items()):
+                self._packed_cmd_response(address, value, length, 'S')
+        return len(self._config)
+
+    # Opens the transport again after the device went away, then restores
+    # the device. The calibration isn't read again, it is the same scope, and
+    # the bitstream is only uploaded when the FPGA lost it. Returns what
+    # restore() returns, with the duration of the whole reconnect.
+    def reopen(self):
+        start = time.time()
+        if self._asyncReader is not None:
+            try:
+                self._asyncReader.stop()
+            except usb1.USBError:
+                # Its transfers went with the device
+                self._asyncReader = None
+        self.invalidate_shadow()
+        if self.transport is None:
+            self._openUsb()
+        else:
+            self.transport.reopen()
+        self._armedAt = None
+        self._check_machine_type()
+        ret = self.restore()
+        ret['duration'] = time.time() - start
+        return ret
+
+    # Number of bitstream chunks sent before waiting for their acks. 1 is what
+    # the Owon software does, larger values need a device that buffers chunks.
+    UPLOAD_WINDOW = 1
+
+    # Uploads the FPGA bitstream, returns statistics about the upload
+    def _uploadBitstream(self,fpgaPath='VDS1022_FPGA_V3.7.bin',window=None):
+        if window is None:
+            window = self.UPLOAD_WINDOW
 
-    def _uploadBitstream(self,fpgaPath='VDS1022_FPGA_V3.7.bin'):
         with open(fpgaPath,'rb') as fpgaFile:
-            bitStream = fpgaFile.read()
+            bitStream = memoryview(fpgaFile.read())
 
-        self.write(AddValueAttachCommand('FPGA_DOWNLOAD_ADD',0x4000,4,len(bitStream)))
+        start = time.time()
+        self._send_register('FPGA_DOWNLOAD_ADD', len(bitStream))
         bufferSize = self.checkResponse('D')
 
         if self.debug:
             print("Buffersize: ",bufferSize)
 
-        i = 0 
-        while i < 1 + (len(bitStream) // (bufferSize - 4)): 
-            # transfer ID
+        # Every chunk is a transfer ID followed by the data
+        chunkSize = bufferSize - 4
+        numChunks = (len(bitStream) + chunkSize - 1) // chunkSize
+        # bulkWrite is done with the buffer when it returns, so one will do
+        chunk = bytearray(bufferSize)
+        chunkView = memoryview(chunk)
+
+        acked = 0
+        for i in range(numChunks):
             if self.debug:
                 print('Sending chunk:',i)
 
-            large_buffer = struct.pack('<I',i)
-
-            pos = i * (bufferSize - 4)
-            length = bufferSize - 4
-            if pos + length > len(bitStream):
-                length = len(bitStream) - pos
-
-            large_buffer += bitStream[pos:pos+length]
-
-            self.write(large_buffer)
-            response = self.checkResponse('S')
-
-            if response != i:
-                raise Exception("Bad response in bitstream upload",hex(i) )
-            i+=1
+            pos = i * chunkSize
+            length = min(chunkSize, len(bitStream) - pos)
+            struct.pack_into('<I',chunk,0,i)
+            chunkView[4:4+length] = bitStream[pos:pos+length]
+            self.write(chunkView[:4+length])
+
+            # Collect the acks of the chunks that fell out of the window
+            while i + 1 - acked >= window:
+                self._checkUploadAck(acked)
+                acked += 1
+
+        while acked < numChunks:
+            self._checkUploadAck(acked)
+            acked += 1
+
+        duration = time.time() - start
+
+        # A freshly loaded FPGA has all its registers reset
+        self.invalidate_shadow()
+
+        self.lastUploadStats = {
+                'bytes': len(bitStream),
+                'chunks': numChunks,
+                'chunkSize': chunkSize,
+                'window': window,
+                'duration': duration,
+                'throughput': len(bitStream) / duration if duration > 0 else 0.0,
+            }
+        return self.lastUploadStats
+
+    def _checkUploadAck(self,i):
+        response = self.checkResponse('S')
+        if response != i:
+            raise Exception("Bad response in bitstream upload",hex(i) )
 
     def _parse_flash(self,buf):
         if buf[0] != 0xaa or buf[1] != 0x55:
@@ -145,47 +429,244 @@ class VDS1022:
         if version != 2:
                 raise Exception("bad flash version %d", version)
 
-        shortBuf = [ buf[i] + (buf[i+1]<<8) for i in range(6,len(buf),2) ]
+        # 3 tables (gain, amplitude, compensation) x 2 channels x 10 voltages
+        values = np.frombuffer(bytes(buf[6:6 + 3*2*10*2]),'<u2')
+        if len(values) != 3*2*10:
+            raise Exception("flash too short")
+        self.calibration_data = values.reshape(3,2,10).tolist()
+
+        if self.verbose:
+            for table in self.calibration_data:
+                for channel in table:
+                    print(' '.join("%3.3X" % x for x in channel))
 
-        count=0
-        for z in range(3):
-            for y in range(2):
-                for x in range(10):
-                    self.calibration_data[z][y][x] = shortBuf[count] & 0xffFF
-                    print("%3.3X"%shortBuf[count],end=' ')
-                    count+=1
-                print()
+        self.invalidate_luts()
 
     def _openUsb(self):
-        handle = usb1.USBContext().openByVendorIDAndProductID(
+        self.transport = UsbTransport(
             self.VENDOR_ID,
             self.PRODUCT_ID,
-            skip_on_error=True,
+            self.INTERFACE,
+            self.BULK_WRITE_ENDPOINT,
+            self.BULK_READ_ENDPOINT,
+            self.device,
         )
-        if handle is None:
-            raise Exception("Device not present, or user is not allowed to access device.")
-
-        handle.claimInterface(self.INTERFACE)
-        handle.clearHalt(self.BULK_WRITE_ENDPOINT)
+        self.invalidate_shadow()
 
-        self.handle = handle
+    # The VDS1022s connected to this machine, as dicts with the bus, address,
+    # port path and serial number (None if it can't be read) of each. The
+    # bus/address tuple or the serial number can be passed as device to open
+    # a specific one.
+    @classmethod
+    def list_devices(cls):
+        return UsbTransport.list_devices(cls.VENDOR_ID, cls.PRODUCT_ID)
 
     def write(self,buf):
         if self.debug:
             print("\nSending: ")
             printBytes(buf)
-        self.handle.bulkWrite(self.BULK_WRITE_ENDPOINT,buf,len(buf))
+        self.transport.write(buf)
+        self.stats.transfer('w',len(buf))
+        if self.journal is not None:
+            self.journal.record(journal.WRITE,self.BULK_WRITE_ENDPOINT,buf)
 
     def read(self,dataLength=DEFAULT_RESPONSE_LENGTH):
-        ret = self.handle.bulkRead(self.BULK_READ_ENDPOINT,dataLength)
+        if self._asyncReader is not None:
+            # The reader owns the read endpoint, responses come out of it in order
+            ret = self._asyncReader.read(dataLength)
+        else:
+            ret = self.transport.read(dataLength)
+        self.stats.transfer('r',len(ret))
+        if self.journal is not None:
+            self.journal.record(journal.READ,self.BULK_READ_ENDPOINT,ret)
         if self.debug:
             print("\nReceived: ")
             printBytes(ret)
         return ret
 
+    # Reads a packet into dest (an int8 numpy array), returns its length
+    def read_into(self,dest):
+        if self._asyncReader is not None:
+            length = self._asyncReader.read_into(dest)
+        else:
+            length = self.transport.read_into(dest)
+        self.stats.transfer('r',length)
+        if self.journal is not None:
+            self.journal.record(journal.READ,self.BULK_READ_ENDPOINT,dest[:length])
+        if self.debug:
+            print("\nReceived: ")
+            printBytes(dest[:length].view(np.uint8))
+        return length
+
+    # Starts recording all USB traffic to a journal (see journal.py). target
+    # is a path, or a journal.JournalWriter that the caller closes itself.
+    def start_journal(self, target):
+        self.stop_journal()
+        if isinstance(target, journal.JournalWriter):
+            self.journal = target
+            self._ownJournal = False
+        else:
+            self.journal = journal.JournalWriter(target)
+            self._ownJournal = True
+
+    def stop_journal(self):
+        if self.journal is not None and self._ownJournal:
+            self.journal.close()
+        self.journal = None
+
+    # Writes value to a register of commands.REGISTERS, by name. offset and
+    # length select a part of it, for registers the scope wants byte by byte.
+    # Returns the value of the response.
+    def write_register(self, name, value, offset=0, length=None, expectedResponse='S'):
+        register = REGISTERS.byName[name]
+        if length is None:
+            length = register.length - offset
+        return self._packed_cmd_response(register.address + offset, value, length, expectedResponse)
+
+    # Sends a command that isn't answered with a response (or with more
+    # than one), the caller reads what comes back
+    def _send_register(self, name, value):
+        register = REGISTERS.byName[name]
+        self.write(self._encoder(register.address,register.length).pack_buffer(value))
+
+    # The encoders reuse their packet buffer, so they aren't shared with
+    # other scopes that may be written to from other threads
+    def _encoder(self, address, length):
+        key = (address,length)
+        encoder = self._encoders.get(key)
+        if encoder is None:
+            encoder = self._encoders[key] = PacketEncoder(address,length)
+        return encoder
+
+    @timed('register')
     def _packed_cmd_response(self, address, value, length, expectedResponse):
-        self.write(AddValueAttachCommand('',address,length,value))
-        return self.checkResponse(expectedResponse)
+        encoder = self._encoder(address,length)
+        shadowed = expectedResponse == 'S' and address in self.SHADOWED_ADDRESSES
+        if shadowed:
+            entry = (length, value & encoder.mask)
+            if self._shadow.get(address) == entry:
+                self._config[address] = entry
+                # The device already has this value
+                self.skippedWrites += 1
+                return None
+            self._shadow[address] = entry
+            self._config[address] = entry
+            # Wider writes also cover the bytes of the following addresses
+            for i in range(1, length):
+                self._shadow.pop(address + i, None)
+                self._config.pop(address + i, None)
+
+        if self._batch is not None:
+            if shadowed:
+                # Setting writes are only acknowledged, so they can be queued
+                self._batch.append(encoder.pack(value))
+                return None
+            # Anything else wants its answer now (a ready flag) or acts on
+            # the settings (capture start), those have to go out first
+            self._flush_batch()
+
+        try:
+            self.write(encoder.pack_buffer(value))
+            return self.checkResponse(expectedResponse)
+        except Exception:
+            # We don't know if the write made it
+            if shadowed:
+                self._shadow.pop(address, None)
+            raise
+
+    # Forget what we think the registers contain, so the next write of every
+    # register goes to the device. Needed when the device could have lost its
+    # state: after a bitstream upload, a reconnect or a failed write.
+    def invalidate_shadow(self):
+        self._shadow = {}
+
+    # Batched register writes:
+    # Instead of doing a write/read round trip for every register, the
+    # setting writes (the shadowed registers) are queued and sent back to
+    # back. The acknowledgements are collected afterwards, so the USB latency
+    # is only paid once per batch. Anything else (ready flags, capture
+    # start, force trigger, 'V','E','D' responses) still goes out
+    # immediately, after the writes queued before it.
+    def begin_batch(self):
+        if self._batch is None:
+            self._batch = []
+
+    def end_batch(self):
+        try:
+            return self._flush_batch()
+        finally:
+            self._batch = None
+            self._afterBatch = []
+
+    # Calls func once the writes done so far reached the device: right away,
+    # or when the batch they are queued in was sent and acknowledged
+    def _after_writes(self,func):
+        if self._batch is None:
+            func()
+        else:
+            self._afterBatch.append(func)
+
+    # Sends the queued writes and checks their acks, the batch stays open
+    @timed('batch')
+    def _flush_batch(self):
+        packets = self._batch
+        self._batch = []
+        (after,self._afterBatch) = (self._afterBatch,[])
+        if not packets:
+            for func in after:
+                func()
+            return 0
+
+        try:
+            for packet in packets:
+                self.write(packet)
+        except Exception:
+            self.invalidate_shadow()
+            raise
+
+        # Always drain all the acks, so a bad one doesn't leave stale
+        # responses in the pipe for the next command
+        errors = []
+        for i in range(len(packets)):
+            try:
+                self.checkResponse('S')
+            except usb1.USBError:
+                self.invalidate_shadow()
+                raise
+            except Exception as e:
+                errors.append((i,e))
+
+        if errors:
+            self.invalidate_shadow()
+            (i,e) = errors[0]
+            address = struct.unpack('<I',packets[i][0:4])[0]
+            raise Exception("Batched write %d of %d (address 0x%x) failed: %s" % (i,len(packets),address,e))
+
+        for func in after:
+            func()
+        return len(packets)
+
+    def abort_batch(self):
+        # The queued values never reached the device
+        if self._batch:
+            self.invalidate_shadow()
+        self._batch = None
+        self._afterBatch = []
+
+    @contextmanager
+    def batch(self):
+        # Nested batches are merged into the outermost one
+        if self._batch is not None:
+            yield
+            return
+
+        self.begin_batch()
+        try:
+            yield
+        except Exception:
+            self.abort_batch()
+            raise
+        self.end_batch()
 
     def checkResponse(self,expected):
         resp = self.read()
@@ -195,8 +676,10 @@ class VDS1022:
 
         return struct.unpack('<I',resp[1:])[0]
 
+    @batched
     def configure_channel(self,channel):
-        print("Configuring channel:",channel)
+        self._log("Configuring channel:",channel)
+        self.invalidate_luts(channel)
         #Channel_ch1/2, bit fields
         #bit 7 channel is on                => 0x80
         #bit 5,6 coupling method ( 1,0,2 )  => 0x20,0,0x40
@@ -206,12 +689,12 @@ class VDS1022:
         #bit 0 no   
         channelArg = 0
 	# channel_ch1 # This sets the voltage
-        print("\tchannel on",self.channelOn[channel])
+        self._log("\tchannel on",self.channelOn[channel])
         if self.channelOn[channel] == True:
             channelArg |= 0x80
         
         #coupling ( 1,0,2)
-        print("\tCoupling",self.coupling[channel])
+        self._log("\tCoupling",self.coupling[channel])
         channelArg |= ( self.coupling[channel] << 5 )
 
         # After voltage 5 we need to set the input attenuation
@@ -219,29 +702,40 @@ class VDS1022:
             channelArg |= 0x1 << 1
 
         # send it to the scope
-        if channel == 0:
-            self._packed_cmd_response( 0x111, channelArg , 1, 'S') # Channel_ch1_ADD
-        else:
-            self._packed_cmd_response( 0x110, channelArg , 1, 'S') # Channel_ch2_add
+        self.write_register(('channel_ch1_ADD','channel_ch2_ADD')[channel], channelArg)
 
 	# volt_gain_ch1
         tmp = self.calibration_data[self.GAIN][channel][self.voltage[channel]]
 
-        print('\tvoltage',hex(self.voltage[channel]))
-        if channel == 0:
-            self._packed_cmd_response( 0x116, tmp, 2, 'S')
-        else:
-            self._packed_cmd_response( 0x114, tmp, 2, 'S')
+        self._log('\tvoltage',hex(self.voltage[channel]))
+        voltage = self.voltage[channel]
+        self.write_register(('volt_gain_ch1_ADD','volt_gain_ch2_ADD')[channel], tmp)
+        # The captures are converted with it, it has to be what the device has
+        def configured():
+            self.configuredVoltage[channel] = voltage
+        self._after_writes(configured)
 
         # zero_off_ch1
         # TODO: 50 should be adjustable #TODO what is going on here
         tmp = self.calibration_data[self.COMPENSATION][channel][self.voltage[channel]]
         tmp -= self.ZEROOFF_HACK * self.calibration_data[self.AMPLITUDE][channel][self.voltage[channel]] // 100
 
-        if channel == 0:
-            self._packed_cmd_response( 0x10a, tmp, 2, 'S')
-        else:
-            self._packed_cmd_response( 0x108, tmp, 2, 'S')
+        self.write_register(('zero_off_ch1_ADD','zero_off_ch2_ADD')[channel], tmp)
+
+        # Keep the transferred channels in sync with the enabled ones
+        self.configure_chl_on()
+
+    # Bit mask of the enabled channels, bit 0 is channel 1
+    def channel_mask(self):
+        mask = 0
+        for i in range(2):
+            if self.channelOn[i]:
+                mask |= 1 << i
+        return mask
+
+    def configure_chl_on(self):
+        # chl_on: Arg appears to be a bit mask of channels to turn on
+        self.write_register('CHL_ON_ADD', self.channel_mask())
 
     # 0x6 = ~16k samples (1 1khz pulse) =  16msps? # at this speed we dont have enough samples to calibrate :(
     # 0xc = ~8k samples (1 1khz pulse) =  8msps? # at this speed we dont have enough samples to calibrate :(
@@ -251,43 +745,41 @@ class VDS1022:
     # 0xc0 = ~500 samples (1 1khz pulse) = 0.5msps
 
 
+    @batched
     def configure_timebase(self,timebase=None): 
-        print("Configuring timebase:",timebase)
+        self._log("Configuring timebase:",timebase)
         if timebase:
             self.timebase = timebase
         # timebase
-        self._packed_cmd_response( 0x52, self.timebase, 4, 'S')
+        self.write_register('TIMEBASE_ADD', self.timebase)
 
-        # slowmove
-        if self.timebase < 0xffFFffFF: #TODO: when do we need to turn on slow-move?
-            self._packed_cmd_response( 0xa, 0, 1, 'S')
-        else:
-            self._packed_cmd_response( 0xa, 1, 1, 'S')
+        # slowmove, only while rolling, see roll()
+        self.write_register('SLOWMOVE_ADD', 1 if self.slowmove else 0)
 
+    @batched
     def capture_init(self):
-        print("Capture init")
+        self._log("Capture init")
         # phase_fine
-        self._packed_cmd_response( 0x18, 0x0, 1, 'S') # PHASE_FINE
-        self._packed_cmd_response( 0x19, 0x0, 1, 'S') # what is this?
+        self.write_register('PHASE_FINE', 0x0, 0, 1)
+        self.write_register('PHASE_FINE', 0x0, 1, 1) # what is this?
 
         # trg
 
         # trg_holdoff_arg_ch1
-        self._packed_cmd_response( 0x26, 0x0, 1, 'S') # trg_holdoff_arg_ext_ADe
+        self.write_register('trg_holdoff_arg_ch1_ADD', 0x0)
 
 
         # trg_holdoff_index_ch1
-        self._packed_cmd_response( 0x27, 0x41, 1, 'S') 
+        self.write_register('trg_holdoff_index_ch1_ADD', 0x41)
 
 #        self.configure_trg_edge_level(0x2832)
         self.configure_trg_edge_level(0x2832)
         self.configure_trg(3,1,0)
 
-        # chl_on: Arg appears to be a bit mask of channels to turn on
-        self._packed_cmd_response( 0xb, 0x3, 1, 'S')
+        self.configure_chl_on()
 
         # edge_level_ext?
-        self._packed_cmd_response( 0x10c, 0, 1, 'S')
+        self.write_register('EMPTY_ADD', 0)
 
         # TODO: here? #TODO: find out what Alyssa meant
         self.configure_channel(0)
@@ -295,13 +787,13 @@ class VDS1022:
         self.configure_timebase(self.timebase)
 
         # sample
-        self._packed_cmd_response( 0x9, 0, 1, 'S')
+        self.write_register('SAMPLE_ADD', 0)
 
         # dm (deep mem)
-        self._packed_cmd_response( 0x5c, 0x13ec, 2, 'S')
+        self.configure_record_length()
 
         # sync output
-        self._packed_cmd_response( 0x6,0, 1, 'S')
+        self.write_register('SYNCOUTPUT_ADD', 0)
 
         self.configure_trg_pre(self.trg_pre);
         self.configure_trg_suf(self.trg_suf);
@@ -310,7 +802,7 @@ class VDS1022:
 
     # triggerChannel channel1 0, channel2 1, external 2
     def configure_trg(self, triggerType,triggerChannel,triggerExtra  ):
-        print("configure_trg triggerType:",triggerType," triggerChannel ",triggerChannel)
+        self._log("configure_trg triggerType:",triggerType," triggerChannel ",triggerChannel)
 
         trgArg = 0
 
@@ -340,52 +832,230 @@ class VDS1022:
             # Sweepidx which is probably 0
             trgArg |= (0<<10) | (0<<11)
             
-        self._packed_cmd_response( 0x24, trgArg, 0x2, 'S') # TRG_ADD
+        self.write_register('TRG_ADD', trgArg)
+
 
 
+    @batched
+    def configure_trg_edge_level(self,val,channel=0):
+        # edge_level_ch1/2
+        # written byte by byte
+        name = ('edge_level_ch1_ADD','edge_level_ch2_ADD')[channel]
+        self.write_register(name, val & 0xff, 0, 1)
+        self.write_register(name, val >> 8, 1, 1)
 
-    def configure_trg_edge_level(self,val):
-        # edge_level_ch1
-        self._packed_cmd_response( 0x2e, val & 0xff, 1, 'S') # pulse_level_ch1_ADD/EDGE LEVEL
-        self._packed_cmd_response( 0x2f, val >> 8, 1, 'S') # 
+    # Edge level register value for a trigger at level (raw ADC counts):
+    # the low byte is the upper threshold, the high byte the lower one, both
+    # signed counts. The layout is only inferred from the 0x2832 capture_init
+    # writes (45 +- 5), it hasn't been checked against triggering hardware.
+    @staticmethod
+    def edge_level(level, hysteresis):
+        high = max(-128, min(127, level + hysteresis))
+        low = max(-128, min(127, level - hysteresis))
+        return ((low & 0xff) << 8) | (high & 0xff)
 
+    @batched
     def configure_trg_suf(self,val):
-        print("configuring trg_suf",val)
-        self._packed_cmd_response( 0x56, val & 0xff, 1, 'S') # SUF_TRG_ADD
-        self._packed_cmd_response( 0x57, val >> 8, 1, 'S')
+        self._log("configuring trg_suf",val)
+        self.trg_suf = val
+        # 4 bytes wide, written byte by byte
+        for i in range(4):
+            self.write_register('SUF_TRG_ADD', (val >> (8 * i)) & 0xff, i, 1)
 
+    @batched
     def configure_trg_pre(self,val):
-        print("configuring trg_pre",val)
-        self._packed_cmd_response( 0x56, val & 0xff, 1, 'S') # SUF_TRG_ADD
-        self._packed_cmd_response( 0x57, val >> 8, 1, 'S')
+        self._log("configuring trg_pre",val)
+        self.trg_pre = val
+        self.write_register('PRE_TRG_ADD', val & 0xff, 0, 1)
+        self.write_register('PRE_TRG_ADD', val >> 8, 1, 1)
+
+    # Number of samples the scope records per channel (the dm register).
+    # Shorter records are transferred quicker, so more captures fit in a
+    # second. The pre and post trigger lengths are cut down to fit.
+    @batched
+    def configure_record_length(self,length=None):
+        if length is not None:
+            if length < self.MIN_RECORD_LENGTH or length > self.MAX_RECORD_LENGTH:
+                raise Exception("record length %d is not within %d..%d" % (length, self.MIN_RECORD_LENGTH, self.MAX_RECORD_LENGTH))
+            self.record_length = length
+        self._log("configuring record length",self.record_length)
+        self.write_register('DM_ADD', self.record_length)
+
+        if self.trg_pre + self.trg_suf > self.record_length:
+            pre = min(self.trg_pre, self.record_length)
+            self.configure_trg_pre(pre)
+            self.configure_trg_suf(self.record_length - pre)
+
+    # Length of the data packet of a channel with the current record length
+    def packet_length(self):
+        return self.FRAME_HEADER_LENGTH + self.TRIGGER_BUFFER_LENGTH + self.record_length
+
+    # Samples per channel get_data returns
+    def samples_per_channel(self):
+        return self.packet_length() - self.FRAME_DATA_OFFSET
 
     def capture_start(self):
-        self._packed_cmd_response( 0x10c, 1, 1, 'S')
-
+        self.write_register('EMPTY_ADD', 1)
+        self._armedAt = time.time()
+
+    # Host time the running capture was started at, None when there is none
+    # (never armed, or lost with a reset of the scope)
+    def armed_at(self):
+        return self._armedAt
+
+    # How long the scope needs to fill the pre and post trigger buffers
+    def estimate_capture_time(self):
+        return (self.trg_pre + self.trg_suf) * self.timebase / self.SAMPLE_CLOCK
+
+    # Wait until the capture started by capture_start is done.
+    # Sleeps for most of the expected acquisition time, then polls with an
+    # exponential backoff, so we don't hammer the bus while waiting.
+    # If no trigger came within timeout seconds a trigger is forced.
+    # Returns (polls,forced): the number of get_data_ready calls needed and
+    # whether the trigger had to be forced.
+    @timed('wait_for_capture')
+    def wait_for_capture(self, timeout=None, sleepFraction=0.8):
+        armedAt = self._armedAt if self._armedAt is not None else time.time()
+        forceAt = armedAt + timeout if timeout is not None else None
+
+        wakeAt = armedAt + self.estimate_capture_time() * sleepFraction
+        if forceAt is not None:
+            wakeAt = min(wakeAt, forceAt)
+        delay = wakeAt - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        polls = 0
+        forced = False
+        interval = self.MIN_POLL_INTERVAL
+        while True:
+            polls += 1
+            if self.get_data_ready() != 0:
+                break
+
+            now = time.time()
+            if not forced and forceAt is not None:
+                if now >= forceAt:
+                    self.force_trigger()
+                    forced = True
+                    interval = self.MIN_POLL_INTERVAL
+                    continue
+                # Don't oversleep the force trigger deadline
+                time.sleep(min(interval, forceAt - now))
+            else:
+                time.sleep(interval)
+            interval = min(interval * 2, self.MAX_POLL_INTERVAL)
+
+        return (polls,forced)
+
+    @timed('get_data_ready')
     def get_data_ready(self):
 	#trg_d
-        self._packed_cmd_response( 0x1, 0, 1, 'S')
+        self.write_register('trg_d_ADD', 0)
 
 	# datafinished
-        return self._packed_cmd_response( 0x7a, 0, 1, 'S')
+        return self.write_register('datafinished_ADD', 0)
 
+    # Only the channels in channelOn are transferred, the data of a disabled
+    # channel is returned as an empty list.
+    @timed('get_data')
     def get_data(self):
-        #self.write(AddValueAttachCommand('',0x1000,2,0x0101)) # getdata_ADD
-        self.write(AddValueAttachCommand('',0x1000,2,0x0505)) # getdata_ADD
+        return self._decode_packets(self._read_packets())
 
-        ret = [ [],[] ]
-
-        for i in range(2):
-            buf = self.read(5200 + 11 )
+    # Sends GETDATA, returns the channels the scope will send a packet for
+    def _request_data(self):
+        channels = [ i for i in range(2) if self.channelOn[i] ]
+        if len(channels) == 0:
+            return channels
 
-            if len(buf) != 5211:
-                # probably EBUSY
-                raise Exception("got incoming packet of size %d, that's bad: ", len(buf))
-                # ouch
+        if len(channels) == 2:
+            self._send_register('GETDATA_ADD', 0x0505)
+        else:
+            # Single channel, the FPGA sends the one enabled in chl_on
+            self._send_register('GETDATA_ADD', 0x0101)
+        return channels
+
+    def _check_packet(self,length,channel):
+        if length != self.packet_length():
+            # probably EBUSY
+            raise Exception("got incoming packet of size %d, that's bad: ", length)
+            # ouch
+
+        if channel < 0 or channel > 1:
+                raise Exception ("invalid channel %d", channel)
+        if not self.channelOn[channel]:
+                raise Exception ("got data for disabled channel %d", channel)
+
+    # Ask for the captured data, returns the raw packets, one per enabled channel
+    def _read_packets(self):
+        packets = []
+        for i in self._request_data():
+            buf = self._read_packet()
+            self._check_packet(len(buf),buf[0])
+            packets.append(buf)
+
+        return packets
+
+    # Reads one data packet. Packets longer than a transfer come in pieces,
+    # the piece that ends with a short USB packet is the last one.
+    def _read_packet(self):
+        length = self.packet_length()
+        pieces = []
+        received = 0
+        while received < length:
+            piece = self.read(length - received)
+            pieces.append(piece)
+            received += len(piece)
+            if len(piece) == 0 or len(piece) % self.USB_PACKET_SIZE != 0:
+                break
+        if len(pieces) == 1:
+            return pieces[0]
+        return b''.join(pieces)
+
+    # Same as _read_packet, into dest (an int8 numpy array) instead
+    def _read_packet_into(self,dest):
+        length = self.packet_length()
+        received = 0
+        while received < length:
+            n = self.read_into(dest[received:length])
+            received += n
+            if n == 0 or n % self.USB_PACKET_SIZE != 0:
+                break
+        return received
+
+    # Like get_data, but the packets are read into the next slot of
+    # ring (a FrameRing) and nothing is converted. Returns the Frame handle of
+    # the slot, which stays valid until the ring wraps around to it again.
+    @timed('read_frame')
+    def read_frame(self,ring,slot=None):
+        if ring.length < self.packet_length():
+            raise Exception("the ring holds packets of %d bytes, the records need %d" % (ring.length, self.packet_length()))
+        slot = ring.acquire(slot)
+        raw = ring.raw[slot]
+        ring.lengths[slot] = self.packet_length()
+
+        for channel in self._request_data():
+            length = self._read_packet_into(raw[channel])
+            # Packets arrive in channel order
+            self._check_packet(length,int(raw[channel,0]))
+            if raw[channel,0] != channel:
+                raise Exception ("expected data for channel %d, got %d", channel, raw[channel,0])
+
+        ring.source = self
+        for channel in range(ring.channels):
+            ring.voltage[slot,channel] = self.configuredVoltage[channel]
+            ring.valid[slot,channel] = self.channelOn[channel]
+        ring.armed[slot] = self._armedAt if self._armedAt is not None else 0.0
+        ring.timestamp[slot] = time.time()
+
+        return ring.frames[slot]
+
+    @timed('decode')
+    def _decode_packets(self,packets):
+        ret = [ [],[] ]
 
+        for buf in packets:
             channel = buf[0]
-            if channel < 0 or channel > 1:
-                    raise Exception ("invalid channel %d", channel)
 
             #num_samples = (5000 - 2) + 50 + 50
 
@@ -394,25 +1064,571 @@ class VDS1022:
             # Owon use only the payload, offset by 1 point, looks like they're trying to avoid some problem when triggering 
             # on square waves (sometimes you get a bad sample (or even two) at the start of the pre), idk
 
-            data_in = np.frombuffer( buf[ 11 + 100 + 1:], '<i1').astype('float32')
-            vdivs = self.vdivs[self.voltage[i]]
-            # Empirically tested :( (there are 10 divs on the OWON screenshot I found. But there are still supposed to be 256 values in a byte...
-            # or optionally only 5 positive divs. So somewhere something is wrong
-            Range = (float(vdivs[0]) / float(vdivs[1])) / 25 #* 10  / 256# value of 1/5? Total range?
-            ret[channel] = Range * ( data_in - self.ZEROOFF_HACK)
+            data_in = np.frombuffer( buf[ self.FRAME_DATA_OFFSET:], '<i1')
+            ret[channel] = self.convert(data_in, channel)
 
         return ret
 
+    # Continuous acquisition on top of the asynchronous reads, see AsyncReader.
+    # Yields the decoded data of count captures (forever if count is None).
+    # The next capture is started as soon as the data of the previous one
+    # is transferred, so the scope is filling its buffer while we decode.
+    # With a FrameRing the raw data is read into the ring and Frame handles
+    # are yielded instead, leaving the conversion to the consumer.
+    # Transports without asynchronous reads (the emulator) just read in turn.
+    def frames(self, count=None, timeout=None, numTransfers=4, ring=None):
+        reader = None
+        if self.transport.supportsAsync:
+            reader = AsyncReader(self, numTransfers, self.packet_length())
+            reader.start()
+        try:
+            n = 0
+            if count is None or count > 0:
+                self.capture_start()
+            while count is None or n < count:
+                self.wait_for_capture(timeout)
+                if ring is not None:
+                    frame = self.read_frame(ring)
+                else:
+                    packets = self._read_packets()
+                n += 1
+                if count is None or n < count:
+                    self.capture_start()
+                if ring is not None:
+                    yield frame
+                else:
+                    yield self._decode_packets(packets)
+        finally:
+            if reader is not None:
+                reader.stop()
+
+    # Calls callback with the data of every capture, see frames()
+    def stream(self, callback, count=None, timeout=None, numTransfers=4, ring=None):
+        for data in self.frames(count, timeout, numTransfers, ring):
+            callback(data)
+
+    # Roll mode: streams the samples while they are acquired, for slow
+    # signals that take too long to fill a whole record. Slow-move is turned
+    # on, the capture is started and triggered right away and every interval
+    # seconds the record is read and the samples acquired since the last read
+    # are yielded as (timestamp, chunk), chunk being like get_data but with
+    # only the new samples. A full record is re-armed, a few samples go
+    # missing in between. The scope doesn't say how far it got, the fill
+    # level is estimated from the time since arming and the sample rate.
+    # The FPGA always sends the whole record, so the reads are spaced out to
+    # bring at least ROLL_MIN_SAMPLES new ones each (up to the end of the
+    # record). A changed timebase or record length is picked up by arming
+    # again. Yields count chunks, forever if count is None; slow-move is
+    # turned off again when the generator is closed.
+    def roll(self, count=None, interval=None):
+        if self.timebase < self.SLOWMOVE_MIN_TIMEBASE:
+            raise Exception("roll needs a timebase of at least 0x%x, not 0x%x" % (self.SLOWMOVE_MIN_TIMEBASE, self.timebase))
+        if interval is None:
+            interval = self.ROLL_INTERVAL
+        packets = np.empty((2, self.MAX_PACKET_LENGTH), dtype=np.int8)
+
+        self.slowmove = True
+        self.configure_timebase()
+        try:
+            n = 0
+            armed = None
+            while count is None or n < count:
+                if armed != (self.timebase, self.record_length):
+                    # First time round, a record that is full or new settings
+                    armed = (self.timebase, self.record_length)
+                    rate = self.SAMPLE_CLOCK / self.timebase
+                    samples = self.samples_per_channel()
+                    position = 0
+                    self.capture_start()
+                    self.force_trigger()
+                wanted = min(samples, position + self.ROLL_MIN_SAMPLES)
+                time.sleep(max(interval, self._armedAt + wanted / rate - time.time()))
+                now = time.time()
+                filled = min(samples, int((now - self._armedAt) * rate))
+                if filled <= position:
+                    continue
+
+                channels = self._request_data()
+                for channel in channels:
+                    received = self._read_packet_into(packets[channel])
+                    self._check_packet(received,int(packets[channel,0]))
+
+                chunk = [ [],[] ]
+                start = self.FRAME_DATA_OFFSET + position
+                for channel in channels:
+                    chunk[channel] = self.convert(packets[channel, start:self.FRAME_DATA_OFFSET + filled], channel)
+
+                position = filled
+                if position == samples:
+                    armed = None
+                n += 1
+                yield (now, chunk)
+        finally:
+            self.slowmove = False
+            if self.transport is not None:
+                try:
+                    self.configure_timebase()
+                except Exception as e:
+                    # Whatever ended the roll matters more, the register is
+                    # written again with the settings on the next restore
+                    print("Unable to turn slow-move off:", e)
+
+    # Segments capture_many reads before converting them, bounds the memory
+    # it needs besides out
+    CAPTURE_MANY_CHUNK = 64
+
+    # Segmented capture: n captures back to back with the current settings,
+    # re-armed with only the capture start write in between (see frames).
+    # Returns (out,timing):
+    #  out     (n, enabled channels, samples) array, int8 for the raw ADC
+    #          counts or one of LUT_DTYPES for converted data. A preallocated
+    #          out can be passed in and is filled in place.
+    #  timing  (n, 2) array with the host time every segment was armed and
+    #          the time its data had been read.
+    def capture_many(self, n, dtype='int8', out=None, timeout=None, numTransfers=4):
+        channels = [ i for i in range(2) if self.channelOn[i] ]
+        shape = (n, len(channels), self.samples_per_channel())
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape:
+            raise Exception("out has shape %s, expected %s" % (out.shape, shape))
+        timing = np.empty((n, 2))
+
+        # The segments are read into a ring of up to CAPTURE_MANY_CHUNK slots,
+        # every time it is full they are converted into out in one pass (while
+        # the scope takes the next capture)
+        ring = FrameRing(max(1, min(n, self.CAPTURE_MANY_CHUNK)), length=self.packet_length())
+        start = 0
+        for (i,frame) in enumerate(self.frames(n, timeout, numTransfers, ring)):
+            end = i + 1
+            if end - start < ring.slots and end < n:
+                continue
+            count = end - start
+            timing[start:end,0] = ring.armed[:count]
+            timing[start:end,1] = ring.timestamp[:count]
+            raw = ring.raw[:count, :, self.FRAME_DATA_OFFSET:self.packet_length()]
+            for (j,channel) in enumerate(channels):
+                if out.dtype == np.int8:
+                    out[start:end,j] = raw[:,channel]
+                else:
+                    self.convert(raw[:,channel], channel, out[start:end,j])
+            start = end
+
+        return (out, timing)
+
+    @classmethod
+    def volts_per_count(cls, voltage):
+        vdivs = cls.vdivs[voltage]
+        # Empirically tested :( (there are 10 divs on the OWON screenshot I found. But there are still supposed to be 256 values in a byte...
+        # or optionally only 5 positive divs. So somewhere something is wrong
+        return (float(vdivs[0]) / float(vdivs[1])) / 25 #* 10  / 256# value of 1/5? Total range?
+
+    # Offset of the zero level in ADC counts. configure_channel moves the zero
+    # by ZEROOFF_HACK counts using the amplitude calibration (compensation
+    # units per 100 counts), with integer rounding. Take that rounding into
+    # account so the conversion matches what the hardware actually did.
+    def zero_offset(self, channel, voltage=None):
+        if voltage is None:
+            voltage = self.configuredVoltage[channel]
+        amplitude = self.calibration_data[self.AMPLITUDE][channel][voltage]
+        if amplitude == 0 or self.ZEROOFF_HACK == 0:
+            return float(self.ZEROOFF_HACK)
+        return (self.ZEROOFF_HACK * amplitude // 100) * 100.0 / amplitude
+
+    # The volts for all 256 ADC values, indexed by the raw byte as uint8
+    def _lut_volts(self, channel, voltage):
+        counts = np.arange(256, dtype=np.uint8).view(np.int8).astype(np.float64)
+        return self.volts_per_count(voltage) * (counts - self.zero_offset(channel, voltage))
+
+    # Lookup table converting raw samples of channel into dtype, which is one
+    # of LUT_DTYPES ('int16' gives millivolts). Tables are built once per
+    # channel, voltage and dtype, configure_channel throws away the ones of
+    # a channel.
+    LUT_DTYPES = ['float32','float16','float64','int16']
+
+    def lut(self, channel, dtype='float32', voltage=None):
+        if voltage is None:
+            voltage = self.configuredVoltage[channel]
+        key = (channel, int(voltage), np.dtype(dtype).name)
+        table = self._luts.get(key)
+        if table is None:
+            if key[2] not in self.LUT_DTYPES:
+                raise Exception("unsupported dtype %s" % key[2])
+            volts = self._lut_volts(channel, voltage)
+            if key[2] == 'int16':
+                table = np.round(volts * 1000).astype(np.int16)
+            else:
+                table = volts.astype(key[2])
+            self._luts[key] = table
+        return table
+
+    def invalidate_luts(self, channel=None):
+        if channel is None:
+            self._luts = {}
+        else:
+            self._luts = { k:v for (k,v) in self._luts.items() if k[0] != channel }
+
+    # Converts raw int8 samples of channel, any shape so a whole batch of
+    # frames goes in one indexing pass. out, when given, must have dtype.
+    def convert(self, raw, channel, out=None, dtype='float32', voltage=None):
+        if out is not None:
+            dtype = out.dtype
+        table = self.lut(channel, dtype, voltage)
+        return np.take(table, np.asarray(raw).view(np.uint8), out=out)
+
     def get_range(self, i):
-        # see above, TODO: de-duplicate
-        vdivs = self.vdivs[self.voltage[i]]
-        Range = (float(vdivs[0]) / float(vdivs[1])) / 25 #* 10  / 256# value of 1/5? Total range?
-        return (Range * (-128 - self.ZEROOFF_HACK), Range * (127 - self.ZEROOFF_HACK))
+        volts = self._lut_volts(i, self.voltage[i])
+        return (float(volts.min()), float(volts.max()))
 
     def force_trigger(self):
-        self._packed_cmd_response( 0xc, 0x3, 1, 'S') # FORCETRIG_add
+        self.write_register('FORCETRG_ADD', 0x3)
+
+    def close(self):
+        if self._asyncReader is not None:
+            self._asyncReader.stop()
+        if self.transport:
+            self.transport.close()
+            self.transport = None
+        self.stop_journal()
+
+
+# The transport moves raw packets between VDS1022 and the scope. This one
+# talks to a real device over libusb, emulator.EmulatedVDS1022 is the
+# hardware-free replacement. A transport needs write(buf), read(length),
+# read_into(dest), identity(), reopen(), close() and a supportsAsync flag
+# (see AsyncReader).
+class UsbTransport:
+    supportsAsync = True
+    # Milliseconds before a transfer fails, so a scope that went away is
+    # noticed instead of waiting on it forever
+    TIMEOUT = 1000
+
+    # device selects the scope: None for the first one found, a
+    # (bus,address) tuple or a serial number string
+    def __init__(self, vendorId, productId, interface, writeEndpoint, readEndpoint, device=None):
+        self.vendorId = vendorId
+        self.productId = productId
+        self.interface = interface
+        self.writeEndpoint = writeEndpoint
+        self.readEndpoint = readEndpoint
+        self.device = device
+
+        # Keep the context around, the asynchronous reads need it to handle events
+        self.context = usb1.USBContext()
+        self.handle = None
+        self._connect()
+
+    def _connect(self):
+        if self.device is None:
+            handle = self.context.openByVendorIDAndProductID(
+                self.vendorId,
+                self.productId,
+                skip_on_error=True,
+            )
+        else:
+            handle = self._open(self.vendorId, self.productId, self.device)
+        if handle is None:
+            raise Exception("Device not present, or user is not allowed to access device.")
+
+        handle.claimInterface(self.interface)
+        handle.clearHalt(self.writeEndpoint)
+
+        self.handle = handle
+        try:
+            self.serial = handle.getSerialNumber()
+        except usb1.USBError:
+            self.serial = None
+
+    # Opens the device again, for when it was unplugged or stopped answering.
+    # A replugged scope gets a new address, it is found by its serial number.
+    # Without one any VDS1022 would be taken, so that is only done when it
+    # is the only one connected.
+    def reopen(self):
+        self.close()
+        if self.serial:
+            self.device = self.serial
+        else:
+            connected = self.list_devices(self.vendorId, self.productId)
+            if len(connected) > 1:
+                raise Exception("Can't tell which of the %d connected scopes to reopen, this one has no serial number" % len(connected))
+            self.device = None
+        self._connect()
+
+    def _open(self, vendorId, productId, device):
+        for usbDevice in self.context.getDeviceIterator(skip_on_error=True):
+            if usbDevice.getVendorID() != vendorId or usbDevice.getProductID() != productId:
+                continue
+            if isinstance(device, tuple):
+                if (usbDevice.getBusNumber(), usbDevice.getDeviceAddress()) == tuple(device):
+                    return usbDevice.open()
+            elif self._serial(usbDevice) == device:
+                return usbDevice.open()
+        return None
+
+    @staticmethod
+    def _serial(usbDevice):
+        try:
+            return usbDevice.getSerialNumber()
+        except usb1.USBError:
+            # Busy, or no permission to open it
+            return None
+
+    @classmethod
+    def list_devices(cls, vendorId, productId):
+        devices = []
+        with usb1.USBContext() as context:
+            for usbDevice in context.getDeviceIterator(skip_on_error=True):
+                if usbDevice.getVendorID() != vendorId or usbDevice.getProductID() != productId:
+                    continue
+                devices.append({
+                        'bus': usbDevice.getBusNumber(),
+                        'address': usbDevice.getDeviceAddress(),
+                        'ports': list(usbDevice.getPortNumberList()),
+                        'serial': cls._serial(usbDevice),
+                    })
+        return devices
+
+    def write(self,buf):
+        self.handle.bulkWrite(self.writeEndpoint,buf,self.TIMEOUT)
+
+    def read(self,length):
+        return self.handle.bulkRead(self.readEndpoint,length,self.TIMEOUT)
+
+    # Reads into dest (an int8 numpy array), returns the length. bulkRead
+    # takes a length and returns its own buffer, which is copied over.
+    def read_into(self,dest):
+        buf = self.handle.bulkRead(self.readEndpoint,len(dest),self.TIMEOUT)
+        dest[:len(buf)] = np.frombuffer(buf,np.int8)
+        return len(buf)
+
+    # Something that identifies this particular scope: the serial number if
+    # it has one, otherwise where it is plugged in.
+    def identity(self):
+        try:
+            serial = self.handle.getSerialNumber()
+        except usb1.USBError:
+            serial = None
+        if serial:
+            return 'serial:' + serial
+        device = self.handle.getDevice()
+        ports = '.'.join(str(port) for port in device.getPortNumberList())
+        return 'port:%d-%s' % (device.getBusNumber(), ports)
 
     def close(self):
         if self.handle:
             self.handle.close()
             self.handle = None
+
+
+# Keeps a number of bulk IN transfers submitted on the read endpoint at all
+# times, so data coming from the scope lands in preallocated buffers as soon
+# as it is sent instead of waiting for us to issue the next bulkRead.
+# Everything the device sends passes through these transfers (the 'S' acks
+# as well as the data packets), so while it runs VDS1022.read() takes its
+# data from here. Transfers complete in the order they were submitted.
+# Idle transfers time out every timeout ms and are submitted again; a read
+# that gets nothing for that long, or a transfer that fails, stops the
+# reader and raises the usb1 exception of the transfer status.
+class AsyncReader:
+    # Exceptions for the failed transfer statuses
+    STATUS_ERRORS = {
+        usb1.TRANSFER_ERROR: usb1.USBErrorIO,
+        usb1.TRANSFER_TIMED_OUT: usb1.USBErrorTimeout,
+        usb1.TRANSFER_CANCELLED: usb1.USBErrorInterrupted,
+        usb1.TRANSFER_STALL: usb1.USBErrorPipe,
+        usb1.TRANSFER_NO_DEVICE: usb1.USBErrorNoDevice,
+        usb1.TRANSFER_OVERFLOW: usb1.USBErrorOverflow,
+    }
+
+    def __init__(self, vds, numTransfers=4, bufferSize=VDS1022.FRAME_PACKET_LENGTH, timeout=UsbTransport.TIMEOUT):
+        self.vds = vds
+        self.bufferSize = bufferSize
+        self.timeout = timeout
+        self._done = deque()
+        self.transfers = []
+        for i in range(numTransfers):
+            transfer = vds.transport.handle.getTransfer()
+            transfer.setBulk(
+                vds.transport.readEndpoint,
+                bytearray(bufferSize),
+                callback=self._onComplete,
+                timeout=timeout,
+            )
+            self.transfers.append(transfer)
+
+    def _onComplete(self, transfer):
+        self._done.append(transfer)
+
+    def start(self):
+        if self.vds._asyncReader is not None:
+            raise Exception("asynchronous reads are already running")
+        for transfer in self.transfers:
+            transfer.submit()
+        self.vds._asyncReader = self
+
+    def stop(self):
+        if self.vds._asyncReader is self:
+            self.vds._asyncReader = None
+        for transfer in self.transfers:
+            if transfer.isSubmitted():
+                try:
+                    transfer.cancel()
+                except usb1.USBError:
+                    pass
+        while any(transfer.isSubmitted() for transfer in self.transfers):
+            self.vds.transport.context.handleEvents()
+        # Anything still waiting is from a capture nobody asked for anymore
+        self._done.clear()
+
+    # Returns the next completed transfer with data, the caller has to
+    # resubmit it
+    def _next(self):
+        deadline = time.time() + self.timeout / 1000
+        while True:
+            while not self._done:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.stop()
+                    raise usb1.USBErrorTimeout()
+                self.vds.transport.context.handleEventsTimeout(remaining)
+
+            transfer = self._done.popleft()
+            status = transfer.getStatus()
+            if status == usb1.TRANSFER_COMPLETED:
+                return transfer
+            if status == usb1.TRANSFER_TIMED_OUT:
+                if transfer.getActualLength() > 0:
+                    # Cut short by the timeout, what did arrive is in order
+                    return transfer
+                # Nothing came while it was waiting, back in the queue
+                transfer.submit()
+                continue
+            # The others are lost with this one, their data would be out of order
+            self.stop()
+            raise self.STATUS_ERRORS.get(status, usb1.USBErrorIO)()
+
+    def read(self, dataLength):
+        transfer = self._next()
+        length = transfer.getActualLength()
+        if length > dataLength:
+            transfer.submit()
+            raise Exception("got %d bytes while expecting at most %d" % (length,dataLength))
+        ret = bytes(transfer.getBuffer()[:length])
+        transfer.submit()
+        return ret
+
+    def read_into(self, dest):
+        transfer = self._next()
+        length = transfer.getActualLength()
+        if length > len(dest):
+            transfer.submit()
+            raise Exception("got %d bytes while expecting at most %d" % (length,len(dest)))
+        dest[:length] = np.frombuffer(transfer.getBuffer(),'<i1',length)
+        transfer.submit()
+        return length
+
+
+# Fixed size ring of raw captures, shaped (slots, channels, packet length).
+# The data packets are read into it, so the captures don't need arrays of
+# their own (the synchronous USB reads still copy from the buffer libusb
+# returns). Each slot has a Frame handle which converts to volts only when
+# asked to.
+# The raw data can live in a buffer provided by the caller, for example
+# shared memory, it needs to hold slots * channels * length bytes.
+# length is the longest packet a slot holds, shorter records only use the
+# start of it (see lengths).
+class FrameRing:
+    def __init__(self, slots, channels=2, length=VDS1022.FRAME_PACKET_LENGTH, buffer=None):
+        self.slots = slots
+        self.channels = channels
+        self.length = length
+        if buffer is None:
+            self.raw = np.zeros((slots, channels, length), dtype=np.int8)
+        else:
+            self.raw = np.ndarray((slots, channels, length), dtype=np.int8, buffer=buffer)
+        # Settings the slot was captured with
+        self.voltage = np.zeros((slots, channels), dtype=np.int8)
+        self.valid = np.zeros((slots, channels), dtype=bool)
+        self.timestamp = np.zeros(slots)
+        # When the capture in the slot was started
+        self.armed = np.zeros(slots)
+        self.sequence = np.zeros(slots, dtype=np.int64)
+        # Packet length of the record in the slot
+        self.lengths = np.full(slots, length, dtype=np.int64)
+        self.frames = [ Frame(self, slot) for slot in range(slots) ]
+        self.count = 0
+        # The VDS1022 that filled the ring, does the conversion
+        self.source = None
+
+    # Next slot to fill, overwriting the oldest one once the ring is full.
+    # The caller can pick the slot itself when it keeps track of free ones.
+    def acquire(self, slot=None):
+        if slot is None:
+            slot = self.count % self.slots
+        self.sequence[slot] = self.count
+        self.valid[slot] = False
+        self.count += 1
+        return slot
+
+    # Converts channel of the given slots (default: all filled ones) in one
+    # pass per voltage setting, out has shape (len(slots), samples).
+    def volts(self, channel, slots=None, out=None, dtype='float32'):
+        if slots is None:
+            slots = [ frame.slot for frame in self.latest() ]
+        slots = np.asarray(slots)
+        lengths = np.unique(self.lengths[slots])
+        if len(lengths) > 1:
+            raise Exception("the frames have different record lengths")
+        raw = self.raw[slots,channel,VDS1022.FRAME_DATA_OFFSET:lengths[0] if len(lengths) else self.length]
+        if out is None:
+            out = np.empty(raw.shape, dtype=dtype)
+        voltages = self.voltage[slots,channel]
+        settings = np.unique(voltages)
+        if len(settings) == 1:
+            # The common case, everything captured with the same setting
+            self.source.convert(raw, channel, out, voltage=settings[0])
+        else:
+            for voltage in settings:
+                select = voltages == voltage
+                out[select] = self.source.convert(raw[select], channel, dtype=out.dtype, voltage=voltage)
+        return out
+
+    # The frames currently in the ring, oldest first
+    def latest(self, n=None):
+        available = min(self.count, self.slots)
+        if n is None or n > available:
+            n = available
+        return [ self.frames[i % self.slots] for i in range(self.count - n, self.count) ]
+
+
+class Frame:
+    def __init__(self, ring, slot):
+        self.ring = ring
+        self.slot = slot
+
+    @property
+    def sequence(self):
+        return int(self.ring.sequence[self.slot])
+
+    @property
+    def timestamp(self):
+        return float(self.ring.timestamp[self.slot])
+
+    def channel_on(self, channel):
+        return bool(self.ring.valid[self.slot,channel])
+
+    # The raw int8 samples, a view into the ring
+    def raw(self, channel):
+        return self.ring.raw[self.slot,channel,VDS1022.FRAME_DATA_OFFSET:self.ring.lengths[self.slot]]
+
+    # The samples converted to volts (millivolts for int16), an empty array
+    # for a disabled channel
+    def volts(self, channel, dtype='float32', out=None):
+        if not self.channel_on(channel):
+            return np.zeros(0, dtype=dtype)
+        return self.ring.source.convert(self.raw(channel), channel, out, dtype,
+                voltage=self.ring.voltage[self.slot,channel])
+
+    # Same as VDS1022.get_data() returns
+    def data(self, dtype='float32'):
+        return [ self.volts(channel, dtype) if self.channel_on(channel) else [] for channel in range(self.ring.channels) ]